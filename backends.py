@@ -0,0 +1,170 @@
+"""
+Backend cho Gemini và OpenWeatherMap. Backend chỉ được tạo khi dùng lần đầu, nên import main.py
+không cần API key và không phải nạp thư viện Gemini. Có thể thay bằng backend giả chạy cục bộ:
+LLM_BACKEND=stub và/hoặc WEATHER_BACKEND=stub (độ trễ giả lập: STUB_LATENCY, giây).
+"""
+import asyncio
+import json
+import os
+import re
+from datetime import datetime, timedelta, timezone
+
+import intent_classifier
+from weather_client import WeatherClient
+
+
+class GeminiBackend:
+    """Bọc google.generativeai; thư viện chỉ được import và cấu hình khi tạo backend."""
+
+    def __init__(self, api_key, model_name="gemini-1.5-flash-latest"):
+        import google.generativeai as genai
+
+        genai.configure(api_key=api_key)
+        self._model = genai.GenerativeModel(model_name)
+
+    async def generate_content_async(self, prompt, **kwargs):
+        return await self._model.generate_content_async(prompt, **kwargs)
+
+
+class StubResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class StubStream:
+    def __init__(self, parts, delay):
+        self._parts = parts
+        self._delay = delay
+
+    async def __aiter__(self):
+        for part in self._parts:
+            await asyncio.sleep(self._delay)
+            yield StubResponse(part)
+
+
+class StubLLMBackend:
+    """
+    Thay cho Gemini khi chạy cục bộ: trả lời tất định, không gọi mạng.
+    Phân tích ý định dùng bộ phân loại cục bộ; các prompt khác nhận câu trả lời mẫu.
+    """
+
+    PLACES_TEXT = "Chợ trung tâm\nBảo tàng thành phố\nCông viên ven sông"
+    FREE_TEXT = "Bạn nên mặc quần áo thoáng mát, mang theo áo khoác mỏng và ô phòng khi trời mưa."
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+
+    def answer(self, prompt, generation_config=None):
+        if generation_config is not None:
+            match = re.search(r'Câu hỏi: "(.*)"', prompt)
+            details, _ = intent_classifier.classify(match.group(1) if match else "")
+            return json.dumps(details, ensure_ascii=False)
+        if "hướng dẫn viên du lịch" in prompt:
+            return self.PLACES_TEXT
+        return self.FREE_TEXT
+
+    async def generate_content_async(self, prompt, stream=False, generation_config=None, **kwargs):
+        text = self.answer(prompt, generation_config)
+        if stream:
+            parts = re.findall(r"\S+\s*", text)
+            return StubStream(parts, self.delay / max(len(parts), 1))
+        await asyncio.sleep(self.delay)
+        return StubResponse(text)
+
+
+def make_weather_payload(city, temp=30.0, city_id=None):
+    return {
+        "id": city_id,
+        "name": city,
+        "timezone": 25200,
+        "main": {"temp": temp, "feels_like": temp + 3, "humidity": 75},
+        "weather": [{"description": "mây rải rác", "icon": "03d"}],
+    }
+
+
+def make_forecast_payload(city, start=None, tz_offset=25200, count=40):
+    start = start or datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    items = []
+    for i in range(count):
+        t = start + timedelta(hours=3 * i)
+        items.append({
+            "dt": int(t.timestamp()),
+            "dt_txt": t.strftime("%Y-%m-%d %H:%M:%S"),
+            "main": {"temp": 25 + (i % 8), "feels_like": 27 + (i % 8), "humidity": 60 + (i % 5) * 5},
+            "weather": [{"description": "mưa nhẹ" if i % 3 else "trời quang", "icon": "10d" if i % 3 else "01d"}],
+        })
+    return {"list": items, "city": {"name": city, "timezone": tz_offset}}
+
+
+class StubWeatherClient:
+    """Thay cho WeatherClient khi chạy cục bộ: sinh payload giống OpenWeatherMap, không gọi mạng."""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+
+    async def get(self, city, type="weather", location=None):
+        if type not in ("weather", "forecast"):
+            return None, "Loại API không hợp lệ"
+        await asyncio.sleep(self.delay)
+        if type == "forecast":
+            return make_forecast_payload(city), None
+        return make_weather_payload(city, city_id=location.id if location else None), None
+
+    async def get_group(self, city_ids):
+        await asyncio.sleep(self.delay)
+        return [make_weather_payload(f"City {city_id}", city_id=city_id) for city_id in city_ids], None
+
+    async def aclose(self):
+        pass
+
+
+def create_llm_backend():
+    if os.getenv("LLM_BACKEND", "gemini") == "stub":
+        return StubLLMBackend(delay=float(os.getenv("STUB_LATENCY", "0")))
+    api_key = os.getenv("GOOGLE_AI_API_KEY")
+    if not api_key:
+        raise RuntimeError("Lỗi: GOOGLE_AI_API_KEY chưa được thiết lập trong file .env")
+    return GeminiBackend(api_key, os.getenv("GEMINI_MODEL", "gemini-1.5-flash-latest"))
+
+
+def create_weather_backend():
+    if os.getenv("WEATHER_BACKEND", "owm") == "stub":
+        return StubWeatherClient(delay=float(os.getenv("STUB_LATENCY", "0")))
+    api_key = os.getenv("OPENWEATHERMAP_API_KEY")
+    if not api_key:
+        raise RuntimeError("Lỗi: OPENWEATHERMAP_API_KEY chưa được thiết lập trong file .env")
+    return WeatherClient.from_env(api_key)
+
+
+class Services:
+    """Các backend dùng chung của ứng dụng; mỗi backend chỉ được tạo khi cần lần đầu."""
+
+    def __init__(self, llm=None, weather=None):
+        self._llm = llm
+        self._weather = weather
+
+    @property
+    def llm(self):
+        if self._llm is None:
+            self._llm = create_llm_backend()
+        return self._llm
+
+    @property
+    def weather(self):
+        if self._weather is None:
+            self._weather = create_weather_backend()
+        return self._weather
+
+    def missing_api_keys(self):
+        """Biến môi trường API key còn thiếu cho các backend sẽ tạo từ cấu hình (backend giả không cần key)."""
+        missing = []
+        if self._llm is None and os.getenv("LLM_BACKEND", "gemini") != "stub" and not os.getenv("GOOGLE_AI_API_KEY"):
+            missing.append("GOOGLE_AI_API_KEY")
+        if self._weather is None and os.getenv("WEATHER_BACKEND", "owm") != "stub" \
+                and not os.getenv("OPENWEATHERMAP_API_KEY"):
+            missing.append("OPENWEATHERMAP_API_KEY")
+        return missing
+
+    async def aclose(self):
+        if self._weather is not None:
+            await self._weather.aclose()
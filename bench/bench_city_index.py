@@ -0,0 +1,122 @@
+"""
+Đo chỉ mục thành phố (city_index.py) với một city.list giả cỡ danh sách thật của OpenWeatherMap:
+thời gian dựng, bộ nhớ so với dict {tên: City} thông thường, và tốc độ tra tên (trúng/trượt, có dấu/không dấu).
+Kiểm tra các tên như "Vĩnh Long" không bị tra nhầm thành Vinh và tên trùng nhau ("London", "Paris") là tên mơ hồ. Cuối cùng đếm số khóa cache khác nhau cho các tên thành phố trong data/intent_corpus.jsonl cộng với
+một số cách viết khác: theo tên đã chuẩn hóa (cách cũ) và theo city ID/tọa độ.
+
+Chạy từ thư mục gốc:  python -m bench.bench_city_index [--cities 200000] [--lookups 200000]
+"""
+import argparse
+import gc
+import gzip
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+import city_index
+from bench.eval_intent_classifier import load_corpus
+from city_index import City, build_city_index, load_city_list, name_key
+from intent_classifier import fold
+from ttl_cache import normalize_key
+
+SYLLABLES = ["Hà", "Nội", "Sơn", "Tây", "Bình", "Phước", "Long", "Thạnh", "Mỹ", "Đông", "Quảng", "Yên",
+             "Thủy", "An", "Tân", "Hòa", "Vĩnh", "Châu", "Đức", "Xuân", "Lộc", "Phú", "Giang", "Kỳ"]
+COUNTRIES = ["VN", "US", "FR", "JP", "IN", "BR", "DE", "CN"]
+VARIANTS = ["Hà Nội", "Ha Noi", "Hanoi", "HÀ NỘI", "Sài Gòn", "TP.HCM", "Saigon", "Hồ Chí Minh",
+            "Đà Nẵng", "Danang", "Huế", "Đà Lạt", "Dalat", "Sapa", "Sa Pa", "Vũng Tàu", "thành phố Vinh", "TP. Huế"]
+# Tên bỏ dấu chứa tên một thành phố ("vinh long" chứa "vinh") nhưng là nơi khác: không được tra ra thành phố đó
+NOT_CITIES = ["Vĩnh Long", "Vĩnh Yên", "Vĩnh Phúc", "vinh long", "Đại Nội Huế"]
+# Tên có nhiều thành phố trong city.list (thủ đô và các thị trấn cùng tên): mơ hồ, phải gọi theo q=...
+DUPLICATES = [("London", "GB", 51.5085, -0.1257), ("London", "CA", 42.9834, -81.2330),
+              ("Paris", "FR", 48.8534, 2.3488), ("Paris", "US", 33.6609, -95.5555)]
+
+
+def make_city_list(path, count, rng):
+    cities = [{"id": 1000000 + i, "name": name, "country": country, "coord": {"lat": lat, "lon": lon}}
+              for i, (name, country, lat, lon) in enumerate(DUPLICATES)]
+    for city_id in range(1, count + 1):
+        name = " ".join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 3)))
+        if rng.random() < 0.5:
+            name = fold(name).title()  # nửa danh sách là tên không dấu như trong city.list thật
+        cities.append({"id": 2000000 + city_id, "name": f"{name} {city_id}", "country": rng.choice(COUNTRIES),
+                       "coord": {"lat": rng.uniform(-90, 90), "lon": rng.uniform(-180, 180)}})
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        json.dump(cities, f)
+    return [city["name"] for city in cities[len(DUPLICATES):]]
+
+
+def measure(build):
+    """Trả về (kết quả, số giây, bộ nhớ còn giữ, bộ nhớ đỉnh); thời gian đo riêng vì tracemalloc làm chậm nhiều lần."""
+    gc.collect()
+    start = time.perf_counter()
+    build()
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, current, peak
+
+
+def lookups_per_second(lookup, queries):
+    start = time.perf_counter()
+    for query in queries:
+        lookup(query)
+    return len(queries) / (time.perf_counter() - start)
+
+
+def main_bench():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cities", type=int, default=200000)
+    parser.add_argument("--lookups", type=int, default=200000)
+    args = parser.parse_args()
+    rng = random.Random(1)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "city.list.json.gz")
+        names = make_city_list(path, args.cities, rng)
+        print(f"city.list giả: {args.cities} thành phố, {os.path.getsize(path) / 1e6:.1f} MB (gzip)")
+
+        index, build_seconds, index_bytes, index_peak = measure(lambda: build_city_index(path))
+        records = load_city_list(path)
+        naive, _, naive_bytes, _ = measure(
+            lambda: {name_key(name): City(city_id, name, lat, lon) for city_id, name, lat, lon, _ in records}
+        )
+        del records
+
+    print(f"{'':>24} | {'bộ nhớ':>9} | {'đỉnh khi dựng':>13} | thời gian dựng")
+    print(f"{'CityIndex (array)':>24} | {index_bytes / 1e6:7.1f}MB | {index_peak / 1e6:11.1f}MB | "
+          f"{build_seconds:.2f}s  (nbytes() = {index.nbytes() / 1e6:.1f}MB)")
+    print(f"{'dict {tên: City}':>24} | {naive_bytes / 1e6:7.1f}MB | {'':>13} |")
+
+    hits = [rng.choice(names) for _ in range(args.lookups // 2)]
+    hits = [fold(name) if rng.random() < 0.5 else name.upper() for name in hits]
+    misses = [f"Không Có {i}" for i in range(args.lookups // 2)]
+    variants = [rng.choice(VARIANTS) for _ in range(args.lookups // 2)]
+    queries = hits + misses
+    rng.shuffle(queries)
+    assert all(index.lookup(name) is not None for name in hits[:1000])
+    assert all(index.lookup(name) is None for name in misses[:1000])
+    assert all(index.resolve(name) is not None for name in VARIANTS)
+    assert all(index.resolve(name) is None for name in NOT_CITIES), [(n, index.resolve(n)) for n in NOT_CITIES]
+    assert all(index.lookup(name) is None for name, *_ in DUPLICATES)
+    print(f"lookup (1/2 trúng, 1/2 trượt): {lookups_per_second(index.lookup, queries):,.0f} lần/giây")
+    print(f"lookup dict (cùng chuẩn hóa tên): {lookups_per_second(lambda q: naive.get(name_key(q)), queries):,.0f} lần/giây")
+    print(f"resolve tên gọi khác ({', '.join(VARIANTS[:4])}, ...): {lookups_per_second(index.resolve, variants):,.0f} lần/giây")
+    city_index._city_index = index
+    print(f"resolve_city (có lru_cache, tên lặp lại): {lookups_per_second(city_index.resolve_city, variants):,.0f} lần/giây")
+
+    cities = [example["city"] for example in load_corpus() if example["city"]] + VARIANTS
+    by_name = {normalize_key(city) for city in cities}
+    by_location = {(index.resolve(city).key if index.resolve(city) else normalize_key(city)) for city in cities}
+    print(f"khóa cache cho {len(cities)} tên thành phố (corpus và các cách viết trên): {len(by_name)} theo tên, "
+          f"{len(by_location)} theo city ID/tọa độ")
+
+
+if __name__ == "__main__":
+    main_bench()
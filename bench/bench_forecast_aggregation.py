@@ -0,0 +1,72 @@
+"""
+Microbenchmark gộp dự báo theo ngày: cách cũ (strptime/datetime.now cho từng mốc, dict lồng list)
+so với aggregate_forecast một lượt duyệt, và khi tóm tắt đã được lưu sẵn trên payload đã cache.
+
+Chạy từ thư mục gốc:  python -m bench.bench_forecast_aggregation
+"""
+import copy
+import os
+import timeit
+from datetime import datetime, timedelta
+
+os.environ.setdefault("GOOGLE_AI_API_KEY", "bench")
+os.environ.setdefault("OPENWEATHERMAP_API_KEY", "bench")
+
+import main
+from bench.stub_owm import make_forecast_payload
+
+ITERATIONS = 2000
+
+
+def legacy_format_daily_forecast(forecast_data, num_days, intent, city_name_override=None):
+    # Bản sao cách gộp cũ để so sánh
+    daily_summary = {}
+    display_city_name = city_name_override or forecast_data.get("city", {}).get("name", "Thành phố này")
+    for item in forecast_data['list']:
+        date_txt = item['dt_txt'].split(' ')[0]
+        if len(daily_summary) >= num_days and date_txt not in daily_summary:
+            if num_days == 1 and datetime.strptime(date_txt, "%Y-%m-%d").date() > (datetime.now() + timedelta(days=1)).date(): break
+            elif len(daily_summary) >= num_days: break
+        if date_txt not in daily_summary:
+            if datetime.strptime(date_txt, "%Y-%m-%d").date() == datetime.now().date():
+                if num_days == 1 and intent in ["forecast_tomorrow", "clothing_advice_tomorrow"]: continue
+            daily_summary[date_txt] = {'temps': [], 'feels_like_temps': [], 'humidity': [], 'descriptions': {}, 'icons': {}}
+        daily_summary[date_txt]['temps'].append(item['main']['temp'])
+        daily_summary[date_txt]['feels_like_temps'].append(item['main']['feels_like'])
+        daily_summary[date_txt]['humidity'].append(item['main']['humidity'])
+        desc = item['weather'][0]['description']
+        icon = item['weather'][0]['icon']
+        daily_summary[date_txt]['descriptions'][desc] = daily_summary[date_txt]['descriptions'].get(desc, 0) + 1
+        daily_summary[date_txt]['icons'][icon] = daily_summary[date_txt]['icons'].get(icon, 0) + 1
+    output_str = f"Dự báo thời tiết cho {display_city_name}:\n"
+    processed_days_count = 0
+    for date_str in sorted(daily_summary.keys()):
+        if processed_days_count >= num_days: break
+        current_date_obj = datetime.now().date()
+        forecast_date_obj = datetime.strptime(date_str, "%Y-%m-%d").date()
+        if intent in ["forecast_tomorrow", "clothing_advice_tomorrow", "forecast_next_days"] and forecast_date_obj <= current_date_obj: continue
+        day_data = daily_summary[date_str]
+        min_temp, max_temp = min(day_data['temps']), max(day_data['temps'])
+        avg_humidity = sum(day_data['humidity']) / len(day_data['humidity'])
+        common_desc = max(day_data['descriptions'], key=day_data['descriptions'].get)
+        formatted_date = datetime.strptime(date_str, "%Y-%m-%d").strftime("%d/%m")
+        output_str += f"- {formatted_date}: {common_desc}, nhiệt độ từ {min_temp:.1f}°C - {max_temp:.1f}°C, độ ẩm khoảng {avg_humidity:.0f}%.\n"
+        processed_days_count += 1
+    return output_str.strip(), None
+
+
+def bench():
+    payload = make_forecast_payload("Huế")
+    fresh = [copy.deepcopy(payload) for _ in range(ITERATIONS)]
+    cases = {
+        "cũ (strptime mỗi mốc)": lambda: legacy_format_daily_forecast(payload, 5, "forecast_next_days"),
+        "mới, payload chưa gộp": lambda: main.format_daily_forecast(fresh.pop(), 5, "forecast_next_days"),
+        "mới, tóm tắt đã lưu sẵn": lambda: main.format_daily_forecast(payload, 5, "forecast_next_days"),
+    }
+    for name, fn in cases.items():
+        seconds = timeit.timeit(fn, number=ITERATIONS)
+        print(f"{name:>24}: {seconds / ITERATIONS * 1e6:8.1f} µs/lần")
+
+
+if __name__ == "__main__":
+    bench()
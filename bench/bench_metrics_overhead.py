@@ -0,0 +1,74 @@
+"""
+Đo chi phí của việc ghi metrics cho /ask: thời gian ghi histogram, thời gian record_request_metrics
+cho một request điển hình, và throughput /ask (backend giả, không độ trễ) khi bật/tắt metrics.
+
+Chạy từ thư mục gốc:  python -m bench.bench_metrics_overhead
+"""
+import asyncio
+import time
+import timeit
+
+import httpx
+
+import main
+from backends import Services, StubLLMBackend, StubWeatherClient
+from metrics import MetricsRegistry
+from request_plan import RequestPlan
+
+QUESTIONS = ["thời tiết Huế", "hôm nay ở Đà Nẵng mặc gì", "dự báo 3 ngày tới ở Hà Nội", "đi đâu chơi ở Huế"]
+TOTAL_REQUESTS = 2000
+ROUNDS = 3
+
+
+def micro():
+    registry = MetricsRegistry()
+    number = 200_000
+    seconds = timeit.timeit(
+        lambda: registry.observe("stage", 0.012, stage="owm:weather", intent="current_weather", cache="hit"),
+        number=number,
+    )
+    print(f"REGISTRY.observe: {seconds / number * 1e9:.0f}ns/lần")
+
+    plan = RequestPlan()
+    plan.tags["intent"] = "clothing_advice_today"
+    plan.spans = [
+        ("intent", 0.0, 0.0001, (), {"source": "local"}),
+        ("owm:weather", 0.0001, 0.05, ("intent",), {"cache": "miss", "status": "200"}),
+        ("format", 0.05, 0.0501, ("owm:weather",), {}),
+        ("gemini:clothing", 0.0501, 0.8, ("format",), {"cache": "miss", "status": "ok"}),
+    ]
+    number = 50_000
+    seconds = timeit.timeit(lambda: main.record_request_metrics(plan, "/ask", "bench"), number=number)
+    print(f"record_request_metrics (4 span): {seconds / number * 1e6:.1f}µs/request")
+
+
+async def throughput(app):
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+        start = time.perf_counter()
+        for i in range(TOTAL_REQUESTS):
+            r = await client.get("/ask", params={"question": QUESTIONS[i % len(QUESTIONS)]})
+            r.raise_for_status()
+        return (time.perf_counter() - start) / TOTAL_REQUESTS
+
+
+def main_bench():
+    micro()
+    app = main.create_app(Services(llm=StubLLMBackend(), weather=StubWeatherClient()))
+    asyncio.run(throughput(app))  # làm nóng cache
+
+    # Chạy xen kẽ vài vòng và lấy giá trị nhỏ nhất để giảm nhiễu
+    enabled, disabled = [], []
+    record_request_metrics, observe = main.record_request_metrics, main.REGISTRY.observe
+    for _ in range(ROUNDS):
+        enabled.append(asyncio.run(throughput(app)))
+        main.record_request_metrics = lambda *args: None
+        main.REGISTRY.observe = lambda *args, **kwargs: None
+        disabled.append(asyncio.run(throughput(app)))
+        main.record_request_metrics, main.REGISTRY.observe = record_request_metrics, observe
+    enabled, disabled = min(enabled), min(disabled)
+    print(f"/ask (cache nóng, backend giả): bật metrics {enabled * 1e6:.0f}µs/request, "
+          f"tắt {disabled * 1e6:.0f}µs/request, chênh {(enabled - disabled) * 1e6:+.0f}µs")
+
+
+if __name__ == "__main__":
+    main_bench()
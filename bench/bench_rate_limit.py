@@ -0,0 +1,171 @@
+"""
+So sánh số câu hỏi được trả lời thành công khi OpenWeatherMap và Gemini giả có quota cứng (vượt quota trả 429):
+không giới hạn phía mình, token bucket không phân độ ưu tiên, và token bucket có ưu tiên intent rẻ.
+Câu hỏi lấy từ data/intent_corpus.jsonl, gửi đều đặn với tốc độ cố định; cache được tắt để mọi câu hỏi
+đều cần gọi upstream (trường hợp xấu nhất khi nhiều thành phố/câu hỏi khác nhau).
+Trước khi đo, check_limiter kiểm tra (assert) các trường hợp của PriorityLimiter: token lấy trước được trả lại,
+lời gọi ưu tiên thấp bị đẩy khỏi hàng đợi đầy, lời gọi chờ quá hạn không bao giờ được cấp token.
+
+Chạy từ thư mục gốc:  python -m bench.bench_rate_limit [--rps 30] [--seconds 10] [--owm-quota 300] [--gemini-quota 180]
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+from collections import Counter
+
+import httpx
+
+import main
+import rate_limit
+from backends import Services, StubLLMBackend
+from bench.eval_intent_classifier import load_corpus
+from bench.stub_owm import start_stub_server
+from rate_limit import (LOW_PRIORITY_INTENTS, PRIORITY_HIGH, PRIORITY_LOW, PriorityLimiter, RateLimitedError,
+                        TokenBucket, prepaid_tokens, release_prepaid)
+from resilience import CircuitBreaker, UpstreamPolicy
+from weather_client import WeatherClient, is_upstream_failure
+
+REFERENCE = "không quota"  # chạy tham chiếu: upstream giả không giới hạn, để biết số câu trả lời lỗi sẵn có
+ERROR_MARKERS = ("Xin lỗi", "Lỗi", "sự cố", "quá nhiều", "thử lại", "Bạn có muốn biết thêm")
+
+
+class ResourceExhausted(Exception):
+    """Như google.api_core.exceptions.ResourceExhausted: mã HTTP trong `code`."""
+    code = 429
+
+
+class QuotaLLM(StubLLMBackend):
+    """Gemini giả có quota: vượt quota thì báo lỗi 429 như API thật. Phân tích ý định trả đúng nhãn của corpus."""
+
+    def __init__(self, per_minute, burst, corpus):
+        super().__init__(delay=0.2)
+        self.quota = TokenBucket(per_minute / 60, burst) if per_minute else None
+        self.labels = {example["question"]: example for example in corpus}
+        self.calls = self.rate_limited = 0
+
+    def answer(self, prompt, generation_config=None):
+        match = re.search(r'Câu hỏi: "(.*)"', prompt)
+        if generation_config is not None and match and match.group(1) in self.labels:
+            example = self.labels[match.group(1)]
+            return json.dumps({key: example[key] for key in ("city", "place_name", "intent", "num_days")}, ensure_ascii=False)
+        return super().answer(prompt, generation_config)
+
+    async def generate_content_async(self, prompt, **kwargs):
+        self.calls += 1
+        if self.quota is not None and not self.quota.try_acquire():
+            self.rate_limited += 1
+            raise ResourceExhausted("429 Resource has been exhausted")
+        return await super().generate_content_async(prompt, **kwargs)
+
+
+def configure(mode, base_url, corpus, args):
+    def limiter(name, per_minute, burst):
+        if mode in (REFERENCE, "không giới hạn"):
+            return None
+        return PriorityLimiter(name, per_minute, burst, max_queue=50, max_wait=2.0)
+
+    weather = WeatherClient("bench", base_url=base_url, policy=UpstreamPolicy(
+        "owm", deadline=8, retries=2, is_failure=is_upstream_failure,
+        breaker=CircuitBreaker("owm", reset_timeout=5), limiter=limiter("owm", args.owm_quota, 10),
+    ))
+    llm = QuotaLLM(None if mode == REFERENCE else args.gemini_quota, 5, corpus)
+    main.gemini_policy.breaker = CircuitBreaker("gemini", reset_timeout=5)
+    main.gemini_policy.limiter = limiter("gemini", args.gemini_quota, 5)
+    # Không phân độ ưu tiên: mọi request giữ độ ưu tiên mặc định
+    main.set_request_priority = rate_limit.set_request_priority if mode == "có ưu tiên" else (lambda intent: None)
+    return main.create_app(Services(llm=llm, weather=weather)), weather, llm
+
+
+async def run_mode(mode, workload, args, stub, base_url, corpus):
+    stub.state.quota = None if mode == REFERENCE else TokenBucket(args.owm_quota / 60, 10)
+    calls_before = stub.state.calls
+    app, weather, llm = configure(mode, base_url, corpus, args)
+    served, total = Counter(), Counter()
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench", timeout=60) as client:
+        async def one(example):
+            r = await client.get("/ask", params={"question": example["question"]})
+            group = "llm" if example["intent"] in LOW_PRIORITY_INTENTS else "rẻ"
+            total[group] += 1
+            if not any(marker in r.json()["message"] for marker in ERROR_MARKERS):
+                served[group] += 1
+
+        tasks = []
+        for example in workload:
+            tasks.append(asyncio.ensure_future(one(example)))
+            await asyncio.sleep(1 / args.rps)
+        await asyncio.gather(*tasks)
+    await weather.aclose()
+
+    owm_429 = stub.state.stats.get("weather", {}).pop("rate_limited", 0) + stub.state.stats.get("forecast", {}).pop("rate_limited", 0)
+    print(f"{mode:>16} | {served['rẻ']:>4}/{total['rẻ']:<4} | {served['llm']:>4}/{total['llm']:<4} | "
+          f"{sum(served.values()):>4}/{len(workload):<4} | {stub.state.calls - calls_before:>5} / {owm_429:<5} | "
+          f"{llm.calls:>5} / {llm.rate_limited:<5}")
+
+
+async def expect_rate_limited(awaitable):
+    try:
+        await awaitable
+    except RateLimitedError:
+        return
+    raise AssertionError("lời gọi lẽ ra phải bị từ chối")
+
+
+async def check_limiter():
+    # Token lấy trước: acquire của cùng request dùng lại mà không lấy thêm; token không dùng được trả lại
+    limiter = PriorityLimiter("check", per_minute=0.6, burst=5)
+    prepaid = {}
+    prepaid_tokens.set(prepaid)
+    assert limiter.prepay(PRIORITY_LOW) and limiter.prepay(PRIORITY_LOW)
+    await limiter.acquire(PRIORITY_LOW)
+    assert int(limiter.bucket.tokens) == 3 and limiter.granted[PRIORITY_LOW] == 2
+    release_prepaid(prepaid)
+    assert int(limiter.bucket.tokens) == 4 and limiter.granted[PRIORITY_LOW] == 1 and not prepaid
+    prepaid_tokens.set(None)
+
+    # Hàng đợi đầy: lời gọi ưu tiên thấp đang chờ bị đẩy ra để nhường chỗ cho lời gọi ưu tiên cao
+    limiter = PriorityLimiter("check", per_minute=0.6, burst=1, max_queue=1, max_wait=0.2)
+    await limiter.acquire(PRIORITY_HIGH)
+    low = asyncio.ensure_future(limiter.acquire(PRIORITY_LOW))
+    await asyncio.sleep(0)
+    high = asyncio.ensure_future(limiter.acquire(PRIORITY_HIGH))
+    await expect_rate_limited(low)
+    assert limiter.rejected[PRIORITY_LOW] == 1 and limiter.queued[PRIORITY_HIGH] == 1
+    await expect_rate_limited(high)  # vẫn chưa có token trong max_wait
+
+    # Lời gọi chờ quá hạn không được cấp token về sau, kể cả khi bucket có token trở lại
+    assert limiter.granted[PRIORITY_HIGH] == 1 and limiter.queued == {PRIORITY_HIGH: 0, PRIORITY_LOW: 0}
+    limiter.bucket.tokens = 1
+    limiter._wakeup.set()
+    await asyncio.sleep(0.05)
+    assert limiter.bucket.tokens >= 1 and limiter.granted[PRIORITY_HIGH] == 1
+    print("PriorityLimiter: token lấy trước, đẩy khỏi hàng đợi, chờ quá hạn -> OK")
+
+
+async def bench(args):
+    corpus = load_corpus()
+    rng = random.Random(1)
+    workload = [rng.choice(corpus) for _ in range(int(args.rps * args.seconds))]
+    base_url, stub = start_stub_server(port=8791, latency=0.02)
+    main.WEATHER_CACHE_TTL.update(weather=0, forecast=0)
+    main.weather_cache.stale_ttl = 0
+    main.clothing_advice_cache.maxsize = 0
+    main.place_recommendations_cache.maxsize = 0
+
+    await check_limiter()
+    print(f"{args.rps} câu hỏi/giây trong {args.seconds} giây; quota OWM {args.owm_quota:g}/phút, Gemini {args.gemini_quota:g}/phút")
+    print(f"{'':>16} | {'thành công':>9} | {'':>9} | {'':>9} | {'gọi OWM / 429':>13} | {'gọi Gemini / 429':>16}")
+    print(f"{'':>16} | {'intent rẻ':>9} | {'intent LLM':>9} | {'tổng':>9} |")
+    for mode in (REFERENCE, "không giới hạn", "không ưu tiên", "có ưu tiên"):
+        await run_mode(mode, workload, args, stub, base_url, corpus)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rps", type=float, default=30)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--owm-quota", type=float, default=300, help="quota của OpenWeatherMap giả, lời gọi/phút")
+    parser.add_argument("--gemini-quota", type=float, default=180, help="quota của Gemini giả, lời gọi/phút")
+    asyncio.run(bench(parser.parse_args()))
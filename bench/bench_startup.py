@@ -0,0 +1,87 @@
+"""
+Đo thời gian khởi động: thời gian `import main` (python -X importtime, liệt kê các module nặng nhất)
+và cold start của `uvicorn main:app` tới khi trả lời được request /ask đầu tiên.
+Server chạy với backend giả (LLM_BACKEND=stub, WEATHER_BACKEND=stub) nên không cần API key hay mạng.
+
+Chạy từ thư mục gốc:  python -m bench.bench_startup [--runs 5] [--top 10]
+"""
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+PORT = 8771
+STUB_ENV = {**os.environ, "LLM_BACKEND": "stub", "WEATHER_BACKEND": "stub"}
+
+
+def import_time(top):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        env=STUB_ENV, capture_output=True, text=True, check=True,
+    )
+    children = []
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+\d+ \|\s+(\d+) \|( *)(\S+)", line)
+        if not match:
+            continue
+        cumulative, depth, name = int(match.group(1)), len(match.group(2)), match.group(3)
+        if depth == 1:
+            # Dòng của module cha được in sau các module con của nó
+            if name == "main":
+                total = cumulative
+                break
+            children = []
+        elif depth == 3:
+            children.append((cumulative, name))
+    direct = sorted(children, reverse=True)[:top]
+    return total, direct
+
+
+def cold_start():
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(PORT), "--log-level", "warning"],
+        env=STUB_ENV,
+    )
+    try:
+        while True:
+            try:
+                r = httpx.get(f"http://127.0.0.1:{PORT}/ask", params={"question": "thời tiết Huế"}, timeout=5)
+                r.raise_for_status()
+                return time.perf_counter() - start
+            except httpx.TransportError:
+                if server.poll() is not None:
+                    raise RuntimeError("uvicorn dừng trước khi sẵn sàng")
+                time.sleep(0.005)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main_bench():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    import_time(args.top)  # lần đầu có thể phải biên dịch .pyc
+    totals = []
+    for _ in range(args.runs):
+        total, direct = import_time(args.top)
+        totals.append(total)
+    print(f"import main: trung vị {statistics.median(totals) / 1000:.0f}ms ({args.runs} lần)")
+    for cumulative, name in direct:
+        print(f"  {cumulative / 1000:8.1f}ms  {name}")
+
+    starts = [cold_start() for _ in range(args.runs)]
+    print(f"uvicorn main:app tới câu trả lời /ask đầu tiên: trung vị {statistics.median(starts) * 1000:.0f}ms, "
+          f"min {min(starts) * 1000:.0f}ms, max {max(starts) * 1000:.0f}ms")
+
+
+if __name__ == "__main__":
+    main_bench()
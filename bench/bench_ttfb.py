@@ -0,0 +1,107 @@
+"""
+Đo time-to-first-byte và tổng thời gian của /ask so với /ask/stream cho các intent có dùng Gemini.
+Gemini giả sinh câu trả lời thành nhiều đoạn, mỗi đoạn cách nhau CHUNK_DELAY giây.
+
+Chạy từ thư mục gốc:  python -m bench.bench_ttfb
+"""
+import asyncio
+import json
+import re
+import threading
+import time
+
+import httpx
+import uvicorn
+
+import main
+from backends import Services, make_forecast_payload, make_weather_payload
+
+CHUNKS = 10
+CHUNK_DELAY = 0.05
+PORT = 8770
+QUESTIONS = {
+    "clothing_advice_today": "hôm nay ở Huế mặc gì",
+    "place_recommendation": "đi đâu chơi ở Huế",
+    "unknown": "Huế",
+}
+
+
+class FakeChunk:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeStream:
+    def __init__(self, parts):
+        self.parts = parts
+
+    async def __aiter__(self):
+        for part in self.parts:
+            await asyncio.sleep(CHUNK_DELAY)
+            yield FakeChunk(part)
+
+
+class FakeGemini:
+    async def generate_content_async(self, prompt, stream=False, **kwargs):
+        if "generation_config" in kwargs:
+            question = re.search(r'Câu hỏi: "(.*)"', prompt).group(1)
+            intent = next(intent for intent, q in QUESTIONS.items() if q == question)
+            return FakeChunk(json.dumps({"city": "Huế", "place_name": "", "intent": intent, "num_days": 1}))
+        if "hướng dẫn viên" in prompt:
+            parts = [f"Địa điểm {i}\n" for i in range(CHUNKS)]
+        else:
+            parts = [f"đoạn {i} " for i in range(CHUNKS)]
+        if stream:
+            return FakeStream(parts)
+        await asyncio.sleep(CHUNK_DELAY * CHUNKS)
+        return FakeChunk("".join(parts))
+
+
+class FakeWeatherClient:
+    async def get(self, city, type="weather", location=None):
+        await asyncio.sleep(0.02)
+        if type == "forecast":
+            return make_forecast_payload(city), None
+        return make_weather_payload(city), None
+
+
+def disable_llm_caches():
+    # Mỗi lần đo đều phải gọi Gemini
+    main.clothing_advice_cache.maxsize = 0
+    main.place_recommendations_cache.maxsize = 0
+
+
+async def measure(client, path, question):
+    start = time.perf_counter()
+    ttfb = None
+    async with client.stream("GET", path, params={"question": question}) as response:
+        async for _ in response.aiter_raw():
+            if ttfb is None:
+                ttfb = time.perf_counter() - start
+    return ttfb, time.perf_counter() - start
+
+
+async def bench():
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{PORT}", timeout=30) as client:
+        print(f"{'intent':>22} | {'/ask ttfb':>9} | {'/ask/stream ttfb':>16} | {'/ask tổng':>9} | {'/ask/stream tổng':>16}")
+        for intent, question in QUESTIONS.items():
+            ask_ttfb, ask_total = await measure(client, "/ask", question)
+            stream_ttfb, stream_total = await measure(client, "/ask/stream", question)
+            print(f"{intent:>22} | {ask_ttfb * 1000:7.0f}ms | {stream_ttfb * 1000:14.0f}ms | "
+                  f"{ask_total * 1000:7.0f}ms | {stream_total * 1000:14.0f}ms")
+
+
+def main_bench():
+    main.LOCAL_INTENT_CLASSIFIER = False
+    app = main.create_app(Services(llm=FakeGemini(), weather=FakeWeatherClient()))
+    disable_llm_caches()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=PORT, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    asyncio.run(bench())
+    server.should_exit = True
+
+
+if __name__ == "__main__":
+    main_bench()
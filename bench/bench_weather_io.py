@@ -0,0 +1,76 @@
+"""
+So sánh throughput của /ask khi gọi OpenWeatherMap bằng requests.get (chặn event loop)
+và bằng WeatherClient bất đồng bộ, với 1, 10 và 100 request /ask đồng thời.
+Cả hai cách đều gọi thẳng upstream cho mỗi request: không qua cache/gộp request của get_weather_data
+và không qua bộ phân loại ý định cục bộ, để chỉ so sánh phần I/O.
+
+Chạy từ thư mục gốc:  python -m bench.bench_weather_io
+"""
+import asyncio
+import time
+
+import httpx
+import requests
+
+import main
+from backends import Services, StubLLMBackend
+from bench.stub_owm import start_stub_server
+from weather_client import WeatherClient
+
+BASE_URL, _ = start_stub_server(latency=0.05)
+
+TOTAL_REQUESTS = 200
+
+
+async def fake_intent(question):
+    return {"city": "Huế", "place_name": "", "intent": "current_weather", "num_days": 1}
+
+
+async def blocking_get_weather_data(city, type="weather"):
+    # Cách gọi cũ: requests.get đồng bộ ngay trong coroutine
+    try:
+        r = requests.get(f"{BASE_URL}/{type}?q={city}&appid=bench&units=metric&lang=vi")
+        r.raise_for_status()
+        return r.json(), None
+    except requests.exceptions.RequestException as req_err:
+        return None, f"Lỗi kết nối: {req_err}"
+
+
+async def pooled_get_weather_data(city, type="weather"):
+    # Cách gọi mới nhưng bỏ qua weather_cache: mỗi request đều gọi OpenWeatherMap giả qua connection pool
+    return await main.get_weather_client().get(city, type=type)
+
+
+async def run_load(app, concurrency):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one():
+            async with semaphore:
+                r = await client.get("/ask", params={"question": "thời tiết Huế"})
+                r.raise_for_status()
+                assert r.json()["message"].startswith("Hiện tại ở Huế"), r.json()["message"]
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(TOTAL_REQUESTS)))
+        return TOTAL_REQUESTS / (time.perf_counter() - start)
+
+
+async def bench():
+    weather = WeatherClient("bench", base_url=BASE_URL)
+    app = main.create_app(Services(llm=StubLLMBackend(), weather=weather))
+    main.LOCAL_INTENT_CLASSIFIER = False
+    main.analyze_user_intent_with_gemini = fake_intent
+    print(f"{'concurrency':>11} | {'before (req/s)':>14} | {'after (req/s)':>13}")
+    for concurrency in (1, 10, 100):
+        main.get_weather_data = blocking_get_weather_data
+        before = await run_load(app, concurrency)
+        main.get_weather_data = pooled_get_weather_data
+        after = await run_load(app, concurrency)
+        print(f"{concurrency:>11} | {before:>14.1f} | {after:>13.1f}")
+    await weather.aclose()
+
+
+if __name__ == "__main__":
+    asyncio.run(bench())
@@ -0,0 +1,68 @@
+"""
+Đánh giá bộ phân loại ý định cục bộ trên tập câu hỏi có nhãn (data/intent_corpus.jsonl).
+Báo cáo tỉ lệ câu xử lý được bằng fast path, độ chính xác trên các câu đó và thời gian phân loại.
+Thêm --llm để chạy cả đường Gemini (cần GOOGLE_AI_API_KEY thật) và so sánh.
+
+Chạy từ thư mục gốc:  python -m bench.eval_intent_classifier [--llm]
+"""
+import argparse
+import asyncio
+import json
+import time
+from pathlib import Path
+
+import intent_classifier
+
+CORPUS_PATH = Path(__file__).resolve().parent.parent / "data" / "intent_corpus.jsonl"
+FIELDS = ("intent", "city", "place_name", "num_days")
+
+
+def load_corpus(path=CORPUS_PATH):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def matches(details, example):
+    return all(details.get(field) == example[field] for field in FIELDS)
+
+
+def eval_local(corpus):
+    covered = correct = 0
+    start = time.perf_counter()
+    for example in corpus:
+        details, confidence = intent_classifier.classify(example["question"])
+        if confidence < intent_classifier.INTENT_CONFIDENCE_THRESHOLD:
+            continue
+        covered += 1
+        if matches(details, example):
+            correct += 1
+        else:
+            print(f"  sai: {example['question']!r} -> {details}")
+    elapsed = time.perf_counter() - start
+    print(f"fast path: {covered}/{len(corpus)} câu ({covered / len(corpus):.0%}), "
+          f"đúng {correct}/{covered} ({correct / max(covered, 1):.0%}), "
+          f"{elapsed / len(corpus) * 1e6:.0f} µs/câu")
+
+
+async def eval_llm(corpus):
+    import main
+
+    correct = agree = 0
+    for example in corpus:
+        details = await main.analyze_user_intent_with_gemini(example["question"])
+        correct += matches(details, example)
+        local, confidence = intent_classifier.classify(example["question"])
+        if confidence >= intent_classifier.INTENT_CONFIDENCE_THRESHOLD:
+            agree += local["intent"] == details["intent"]
+    print(f"gemini: đúng {correct}/{len(corpus)} ({correct / len(corpus):.0%}), "
+          f"trùng intent với fast path: {agree} câu")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--llm", action="store_true", help="chạy cả đường Gemini để so sánh")
+    args = parser.parse_args()
+    corpus = load_corpus()
+    eval_local(corpus)
+    if args.llm:
+        asyncio.run(eval_llm(corpus))
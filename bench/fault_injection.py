@@ -0,0 +1,120 @@
+"""
+Giả lập sự cố upstream và kiểm tra độ trễ của /ask vẫn bị chặn trên:
+OpenWeatherMap trả lỗi 500, OpenWeatherMap treo, Gemini treo, rồi phục hồi.
+OpenWeatherMap giả chạy bằng bench/stub_owm.py (qua WeatherClient thật), Gemini giả là StubLLMBackend.
+Deadline và thời gian ngắt mạch được đặt ngắn để kịch bản chạy nhanh.
+
+Chạy từ thư mục gốc:  python -m bench.fault_injection
+"""
+import asyncio
+import sys
+import time
+
+import httpx
+
+import main
+from backends import Services, StubLLMBackend
+from bench.stub_owm import start_stub_server
+from resilience import CircuitBreaker, UpstreamPolicy
+from weather_client import WeatherClient, is_upstream_failure
+
+OWM_DEADLINE = 1.0
+GEMINI_DEADLINE = 1.0
+BREAKER_RESET = 1.0
+CACHE_TTL = 0.5
+SLACK = 0.5  # chi phí xử lý cho phép ngoài deadline
+STALE_MARKER = "Dữ liệu được cập nhật cách đây"
+CITIES = ["Huế", "Hà Nội", "Đà Nẵng", "Cần Thơ", "Đà Lạt"]
+
+
+class FaultyLLM(StubLLMBackend):
+    def __init__(self):
+        super().__init__(delay=0.01)
+        self.hang = False
+
+    async def generate_content_async(self, prompt, **kwargs):
+        if self.hang:
+            await asyncio.sleep(3600)
+        return await super().generate_content_async(prompt, **kwargs)
+
+
+async def ask(client, question, path="/ask"):
+    start = time.perf_counter()
+    if path == "/ask":
+        r = await client.get(path, params={"question": question})
+        message = r.json()["message"]
+    else:
+        r = await client.get(path, params={"question": question})
+        message = r.text
+    return time.perf_counter() - start, message
+
+
+async def phase(client, name, questions, bound, check=None, path="/ask"):
+    results = await asyncio.gather(*(ask(client, question, path) for question in questions))
+    latencies = sorted(latency for latency, _ in results)
+    ok = latencies[-1] <= bound and (check is None or all(check(message) for _, message in results))
+    breakers = (await client.get("/stats/upstream")).json()
+    print(f"{name:>34}: {len(results):3} request, p50 {latencies[len(latencies) // 2] * 1000:6.0f}ms, "
+          f"max {latencies[-1] * 1000:6.0f}ms (giới hạn {bound * 1000:.0f}ms), "
+          f"owm={breakers['owm']['state']}, gemini={breakers['gemini']['state']} -> {'OK' if ok else 'SAI'}")
+    if not ok:
+        print(f"    ví dụ câu trả lời: {results[-1][1][:200]!r}")
+    return ok
+
+
+async def run():
+    base_url, stub = start_stub_server(port=8790, latency=0.02)
+    llm = FaultyLLM()
+    weather = WeatherClient(
+        "bench", base_url=base_url, timeout=OWM_DEADLINE,
+        policy=UpstreamPolicy(
+            "owm", deadline=OWM_DEADLINE, retries=2, backoff=0.05, is_failure=is_upstream_failure,
+            breaker=CircuitBreaker("owm", failure_threshold=5, reset_timeout=BREAKER_RESET),
+        ),
+    )
+    app = main.create_app(Services(llm=llm, weather=weather))
+    main.gemini_policy.deadline = GEMINI_DEADLINE
+    main.gemini_policy.breaker.reset_timeout = BREAKER_RESET
+    main.WEATHER_CACHE_TTL.update(weather=CACHE_TTL, forecast=CACHE_TTL)
+    main.clothing_advice_cache.maxsize = 0
+    main.place_recommendations_cache.maxsize = 0
+
+    weather_questions = [f"thời tiết {city}" for city in CITIES] * 10
+    clothing_questions = [f"hôm nay ở {city} mặc gì" for city in CITIES] * 4
+    results = []
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://fault", timeout=60) as client:
+        results.append(await phase(client, "bình thường", weather_questions, 0.5,
+                                   check=lambda m: STALE_MARKER not in m))
+
+        stub.state.error_rate = 1.0
+        await asyncio.sleep(CACHE_TTL)
+        calls_before = stub.state.calls
+        results.append(await phase(client, "OWM trả 500 (dùng cache cũ)", weather_questions, OWM_DEADLINE + SLACK,
+                                   check=lambda m: STALE_MARKER in m))
+        print(f"{'':>36}OWM giả nhận {stub.state.calls - calls_before} lời gọi cho {len(weather_questions)} request")
+        results.append(await phase(client, "OWM trả 500, thành phố chưa cache", ["thời tiết Vũng Tàu"] * 10, 0.1))
+
+        stub.state.error_rate = 0.0
+        stub.state.latency = 3600
+        await asyncio.sleep(BREAKER_RESET)
+        results.append(await phase(client, "OWM treo", weather_questions + ["thời tiết Nha Trang"] * 5,
+                                   OWM_DEADLINE + SLACK))
+
+        stub.state.latency = 0.02
+        llm.hang = True
+        await asyncio.sleep(BREAKER_RESET)
+        results.append(await phase(client, "Gemini treo", clothing_questions, GEMINI_DEADLINE + OWM_DEADLINE + SLACK))
+        results.append(await phase(client, "Gemini treo (/ask/stream)", clothing_questions[:5],
+                                   GEMINI_DEADLINE + OWM_DEADLINE + SLACK, path="/ask/stream"))
+
+        llm.hang = False
+        await asyncio.sleep(BREAKER_RESET + CACHE_TTL)
+        results.append(await phase(client, "phục hồi", [clothing_questions[0]], 0.5))
+        results.append(await phase(client, "sau phục hồi", weather_questions + clothing_questions, 0.5,
+                                   check=lambda m: STALE_MARKER not in m and "Xin lỗi" not in m))
+    await weather.aclose()
+    return all(results)
+
+
+if __name__ == "__main__":
+    sys.exit(0 if asyncio.run(run()) else 1)
@@ -0,0 +1,204 @@
+"""
+Load test /ask hoàn toàn offline: app chạy bằng uvicorn trong process riêng, gọi OpenWeatherMap giả
+(bench/stub_owm.py, process riêng, có độ trễ và tỉ lệ lỗi) và Gemini giả (LLM_BACKEND=stub).
+Câu hỏi lấy từ data/intent_corpus.jsonl (nhiều intent). Báo cáo throughput, phân vị độ trễ,
+số lần gọi OpenWeatherMap/Gemini trung bình theo intent; lưu kết quả ra JSON để so với baseline.
+
+Chạy từ thư mục gốc:
+    python -m bench.load_test [--requests 2000] [--concurrency 50] [--owm-latency 0.05]
+        [--owm-error-rate 0.01] [--llm-latency 0.3] [--cold] [--no-local-intent]
+        [--save kết_quả.json] [--baseline baseline.json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+import httpx
+
+from bench.eval_intent_classifier import load_corpus
+
+APP_PORT = 8780
+OWM_PORT = 8781
+
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def wait_until_up(url, process):
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Process cho {url} đã dừng")
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.TransportError:
+            time.sleep(0.05)
+    raise RuntimeError(f"{url} không sẵn sàng sau 30 giây")
+
+
+def start_servers(args):
+    owm = subprocess.Popen([
+        sys.executable, "-m", "bench.stub_owm", "--port", str(OWM_PORT), "--latency", str(args.owm_latency),
+        "--jitter", str(args.owm_jitter), "--error-rate", str(args.owm_error_rate), "--seed", str(args.seed),
+    ])
+    env = {
+        **os.environ,
+        "LLM_BACKEND": "stub",
+        "STUB_LATENCY": str(args.llm_latency),
+        "OPENWEATHERMAP_API_KEY": "bench",
+        "OPENWEATHERMAP_BASE_URL": f"http://127.0.0.1:{OWM_PORT}",
+        "LOCAL_INTENT_CLASSIFIER": "0" if args.no_local_intent else "1",
+    }
+    env.pop("WEATHER_BACKEND", None)
+    env.pop("LLM_CACHE_PATH", None)
+    if args.cold:
+        # Tắt cache để mọi request đều phải gọi upstream (chỉ còn gộp request đồng thời)
+        env.update(OWM_CACHE_TTL_WEATHER="0", OWM_CACHE_TTL_FORECAST="0",
+                   CLOTHING_ADVICE_CACHE_TTL="0", PLACE_RECOMMENDATIONS_CACHE_TTL="0")
+    app = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(APP_PORT), "--log-level", "warning"], env=env,
+    )
+    try:
+        wait_until_up(f"http://127.0.0.1:{OWM_PORT}/_stats", owm)
+        wait_until_up(f"http://127.0.0.1:{APP_PORT}/stats/cache", app)
+    except Exception:
+        stop_servers(owm, app)
+        raise
+    return owm, app
+
+
+def stop_servers(*processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.wait()
+
+
+async def drive(args, corpus):
+    rng = random.Random(args.seed)
+    workload = [rng.choice(corpus) for _ in range(args.requests)]
+    results = []
+    semaphore = asyncio.Semaphore(args.concurrency)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{APP_PORT}", timeout=60, limits=limits) as client:
+        async def one(example):
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    r = await client.get("/ask", params={"question": example["question"], "trace": "true"})
+                    r.raise_for_status()
+                except httpx.HTTPError:
+                    results.append((example["intent"], time.perf_counter() - start, None, None, False))
+                    return
+                latency = time.perf_counter() - start
+                spans = r.json()["trace"]["spans"]
+                owm_calls = sum(
+                    1 for span in spans
+                    if span["name"].startswith(("owm:", "prefetch:")) and span["tags"].get("cache") == "miss"
+                )
+                results.append((example["intent"], latency, owm_calls, int(r.headers["X-LLM-Calls"]), True))
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(example) for example in workload))
+        elapsed = time.perf_counter() - start
+    return results, elapsed
+
+
+def summarize(results, elapsed):
+    def describe(rows):
+        ok = [row for row in rows if row[4]]
+        latencies = [row[1] * 1000 for row in ok]
+        return {
+            "requests": len(rows),
+            "errors": len(rows) - len(ok),
+            "p50_ms": round(percentile(latencies, 50), 1),
+            "p90_ms": round(percentile(latencies, 90), 1),
+            "p99_ms": round(percentile(latencies, 99), 1),
+            "max_ms": round(max(latencies, default=0), 1),
+            "owm_calls_per_request": round(statistics.fmean(row[2] for row in ok), 3) if ok else 0,
+            "llm_calls_per_request": round(statistics.fmean(row[3] for row in ok), 3) if ok else 0,
+        }
+
+    by_intent = defaultdict(list)
+    for row in results:
+        by_intent[row[0]].append(row)
+    return {
+        "throughput_rps": round(len(results) / elapsed, 1),
+        "overall": describe(results),
+        "intents": {intent: describe(rows) for intent, rows in sorted(by_intent.items())},
+    }
+
+
+def print_report(summary, baseline=None):
+    columns = ("requests", "errors", "p50_ms", "p90_ms", "p99_ms", "max_ms", "owm_calls_per_request",
+               "llm_calls_per_request")
+    headers = ("n", "lỗi", "p50 ms", "p90 ms", "p99 ms", "max ms", "OWM/req", "Gemini/req")
+
+    def fmt(value, base):
+        text = f"{value:g}"
+        if base is not None and base != value:
+            text += f" ({value - base:+g})"
+        return text
+
+    base_throughput = baseline["throughput_rps"] if baseline else None
+    print(f"throughput: {fmt(summary['throughput_rps'], base_throughput)} req/s")
+    print(f"{'intent':>26} | " + " | ".join(f"{header:>16}" for header in headers))
+    rows = [("tổng", summary["overall"], baseline and baseline["overall"])]
+    rows += [(intent, stats, baseline and baseline["intents"].get(intent)) for intent, stats in summary["intents"].items()]
+    for name, stats, base in rows:
+        cells = [fmt(stats[column], base[column] if base else None) for column in columns]
+        print(f"{name:>26} | " + " | ".join(f"{cell:>16}" for cell in cells))
+
+
+def main_bench():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--owm-latency", type=float, default=0.05)
+    parser.add_argument("--owm-jitter", type=float, default=0.5)
+    parser.add_argument("--owm-error-rate", type=float, default=0.0)
+    parser.add_argument("--llm-latency", type=float, default=0.3)
+    parser.add_argument("--cold", action="store_true", help="tắt cache thời tiết và cache Gemini")
+    parser.add_argument("--no-local-intent", action="store_true", help="luôn phân tích ý định bằng Gemini (giả)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save", help="ghi kết quả ra file JSON")
+    parser.add_argument("--baseline", help="file JSON từ một lần chạy trước để so sánh")
+    args = parser.parse_args()
+
+    corpus = load_corpus()
+    owm, app = start_servers(args)
+    try:
+        results, elapsed = asyncio.run(drive(args, corpus))
+        owm_stats = httpx.get(f"http://127.0.0.1:{OWM_PORT}/_stats").json()
+    finally:
+        stop_servers(app, owm)
+
+    summary = summarize(results, elapsed)
+    summary["config"] = {key: value for key, value in vars(args).items() if key not in ("save", "baseline")}
+    summary["owm_server"] = owm_stats
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(summary, baseline)
+    print(f"OpenWeatherMap giả nhận: {json.dumps(owm_stats)}")
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,104 @@
+"""
+Kiểm tra cô lập giữa các request /ask chạy đồng thời: bắn hàng nghìn câu hỏi với nhiều intent
+khác nhau cùng lúc (OpenWeatherMap và Gemini được thay bằng bản giả có độ trễ ngẫu nhiên),
+rồi so từng câu trả lời với kết quả khi chạy câu hỏi đó một mình.
+
+Chạy từ thư mục gốc:  python -m bench.stress_concurrency [--requests 3000]
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+import sys
+
+import httpx
+
+import main
+from backends import Services, make_forecast_payload, make_weather_payload
+
+CITIES = ["Huế", "Hà Nội", "Đà Nẵng", "Cần Thơ", "Đà Lạt"]
+TEMPLATES = {
+    "current_weather": "thời tiết {city} bây giờ",
+    "clothing_advice_today": "hôm nay ở {city} mặc gì",
+    "forecast_tomorrow": "ngày mai {city} có mưa không",
+    "clothing_advice_tomorrow": "mai đi {city} nên mặc gì",
+    "forecast_next_days": "dự báo {num_days} ngày tới ở {city}",
+    "place_recommendation": "đi đâu chơi ở {city}",
+    "specific_place_navigation": "chỉ đường đến chợ trung tâm {city}",
+}
+
+
+def build_questions():
+    questions = {}
+    for i, city in enumerate(CITIES):
+        for intent, template in TEMPLATES.items():
+            num_days = 2 + i % 4 if intent == "forecast_next_days" else 1
+            place_name = f"chợ trung tâm {city}" if intent == "specific_place_navigation" else ""
+            question = template.format(city=city, num_days=num_days)
+            questions[question] = {"city": city, "place_name": place_name, "intent": intent, "num_days": num_days}
+    return questions
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeGemini:
+    def __init__(self, questions):
+        self.questions = questions
+
+    async def generate_content_async(self, prompt, **kwargs):
+        await asyncio.sleep(random.uniform(0, 0.02))
+        if "generation_config" in kwargs:
+            question = re.search(r'Câu hỏi: "(.*)"', prompt).group(1)
+            return FakeResponse(json.dumps(self.questions[question], ensure_ascii=False))
+        if "hướng dẫn viên" in prompt:
+            city = re.search(r'thành phố "(.*?)"', prompt).group(1)
+            return FakeResponse(f"Chợ {city}\nBảo tàng {city}")
+        return FakeResponse(f"Lời khuyên cho: {prompt.split('Thời tiết ', 1)[-1]}")
+
+
+class FakeWeatherClient:
+    def __init__(self):
+        self.forecasts = {city: make_forecast_payload(city) for city in CITIES}
+
+    async def get(self, city, type="weather", location=None):
+        await asyncio.sleep(random.uniform(0, 0.02))
+        if type == "forecast":
+            return self.forecasts[city], None
+        return make_weather_payload(city, temp=20 + CITIES.index(city) * 3), None
+
+
+async def ask(client, question):
+    r = await client.get("/ask", params={"question": question})
+    r.raise_for_status()
+    return r.json()["message"]
+
+
+async def run(total):
+    questions = build_questions()
+    main.LOCAL_INTENT_CLASSIFIER = False  # buộc đi qua Gemini giả để các request xen kẽ nhau nhiều hơn
+    app = main.create_app(Services(llm=FakeGemini(questions), weather=FakeWeatherClient()))
+    # Tắt cache thời tiết để mỗi request đều phải chờ upstream giữa lúc phân tích ý định và lúc định dạng
+    main.WEATHER_CACHE_TTL.update(weather=0, forecast=0)
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://stress") as client:
+        expected = {question: await ask(client, question) for question in questions}
+        workload = [random.choice(list(questions)) for _ in range(total)]
+        answers = await asyncio.gather(*(ask(client, question) for question in workload))
+
+    mismatches = [(q, a) for q, a in zip(workload, answers) if a != expected[q]]
+    print(f"{total} request đồng thời, {len(questions)} câu hỏi khác nhau, {len(mismatches)} câu trả lời sai")
+    for question, answer in mismatches[:5]:
+        print(f"  {question!r}\n    mong đợi: {expected[question]!r}\n    nhận được: {answer!r}")
+    return not mismatches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=3000)
+    args = parser.parse_args()
+    sys.exit(0 if asyncio.run(run(args.requests)) else 1)
@@ -0,0 +1,101 @@
+"""
+Server giả lập OpenWeatherMap (/weather, /forecast, /group) chạy cục bộ để benchmark
+mà không tốn quota API thật; độ trễ và tỉ lệ lỗi có thể cấu hình.
+"""
+import argparse
+import asyncio
+import random
+import threading
+import time
+import zlib
+
+import uvicorn
+from fastapi import FastAPI, HTTPException, Query
+
+from backends import make_forecast_payload, make_weather_payload
+from rate_limit import TokenBucket
+
+
+def create_stub_app(latency=0.05, jitter=0.0, error_rate=0.0, seed=None, quota=0, quota_burst=10):
+    """
+    Mỗi request chờ latency * U(1 - jitter, 1 + jitter) giây; với xác suất error_rate trả về HTTP 500.
+    Nếu quota > 0, request vượt quá `quota` lời gọi/phút (token bucket, tối đa quota_burst liên tiếp) nhận HTTP 429.
+    Số lần gọi theo từng endpoint xem ở GET /_stats. Có thể đổi stub.state.latency/jitter/error_rate
+    khi đang chạy để giả lập sự cố.
+    """
+    stub = FastAPI()
+    stub.state.calls = 0
+    stub.state.stats = {}
+    stub.state.latency = latency
+    stub.state.jitter = jitter
+    stub.state.error_rate = error_rate
+    stub.state.quota = TokenBucket(quota / 60, quota_burst) if quota > 0 else None
+    rng = random.Random(seed)
+
+    async def simulate(path):
+        stub.state.calls += 1
+        stats = stub.state.stats.setdefault(path, {"calls": 0, "errors": 0})
+        stats["calls"] += 1
+        if stub.state.quota is not None and not stub.state.quota.try_acquire():
+            stats["rate_limited"] = stats.get("rate_limited", 0) + 1
+            raise HTTPException(status_code=429, detail="Vượt quota")
+        await asyncio.sleep(stub.state.latency * rng.uniform(1 - stub.state.jitter, 1 + stub.state.jitter))
+        if rng.random() < stub.state.error_rate:
+            stats["errors"] += 1
+            raise HTTPException(status_code=500, detail="Lỗi giả lập")
+
+    def place(q, id, lat, lon):
+        """Tên hiển thị cho request theo tên (q), city ID hoặc tọa độ."""
+        if q:
+            return q
+        return f"City {id}" if id else f"{lat},{lon}"
+
+    @stub.get("/weather")
+    async def weather(q: str = Query(""), id: int = Query(None), lat: float = Query(None), lon: float = Query(None)):
+        await simulate("weather")
+        name = place(q, id, lat, lon)
+        return make_weather_payload(name, temp=20 + zlib.crc32(name.encode()) % 15, city_id=id)
+
+    @stub.get("/forecast")
+    async def forecast(q: str = Query(""), id: int = Query(None), lat: float = Query(None), lon: float = Query(None)):
+        await simulate("forecast")
+        return make_forecast_payload(place(q, id, lat, lon))
+
+    @stub.get("/group")
+    async def group(id: str = Query("")):
+        await simulate("group")
+        ids = [int(city_id) for city_id in id.split(",") if city_id]
+        return {"cnt": len(ids), "list": [
+            make_weather_payload(f"City {city_id}", temp=20 + zlib.crc32(f"City {city_id}".encode()) % 15, city_id=city_id)
+            for city_id in ids
+        ]}
+
+    @stub.get("/_stats")
+    async def stats():
+        return stub.state.stats
+
+    return stub
+
+
+def start_stub_server(port=8765, latency=0.05, jitter=0.0, error_rate=0.0, quota=0):
+    """Chạy server giả lập trong thread nền, trả về (base_url, app)."""
+    stub = create_stub_app(latency, jitter, error_rate, quota=quota)
+    server = uvicorn.Server(uvicorn.Config(stub, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return f"http://127.0.0.1:{port}", stub
+
+
+if __name__ == "__main__":
+    # Chạy riêng một process:  python -m bench.stub_owm --port 8765 --latency 0.05 --error-rate 0.01
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--quota", type=float, default=0, help="số lời gọi/phút, vượt quá trả về 429")
+    args = parser.parse_args()
+    uvicorn.run(create_stub_app(args.latency, args.jitter, args.error_rate, args.seed, args.quota),
+                host="127.0.0.1", port=args.port, log_level="warning")
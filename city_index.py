@@ -0,0 +1,188 @@
+"""
+Chỉ mục thành phố cục bộ: tên thành phố (không phân biệt dấu, hoa thường, dấu câu, kể cả tên gọi khác)
+-> city ID và tọa độ của OpenWeatherMap, để gọi thời tiết theo ID/tọa độ thay vì chuỗi tự do q=...
+Mọi cách viết của cùng một thành phố ("Hà Nội", "Ha Noi", "Hanoi") vì thế dùng chung một khóa cache.
+
+Ngoài bảng các thành phố Việt Nam có sẵn, có thể nạp danh sách city.list.json(.gz) đầy đủ của OpenWeatherMap
+(~200 nghìn thành phố) qua biến môi trường CITY_LIST_PATH. Dữ liệu được giữ trong các array kiểu số
+(không tạo object Python cho từng thành phố): tên được băm thành số 64 bit, sắp xếp và tra bằng tìm kiếm nhị phân.
+Với city.list đầy đủ, chỉ mục chiếm khoảng 9 MB nhưng lúc dựng (đọc JSON) cần hơn 100 MB và vài giây.
+"""
+import array
+import bisect
+import gzip
+import json
+import os
+import unicodedata
+from collections import namedtuple
+from functools import lru_cache
+
+from intent_classifier import CITY_GAZETTEER, fold
+
+# (tên chuẩn, city ID của OpenWeatherMap hoặc 0 nếu chưa có, vĩ độ, kinh độ); thành phố không có ID được gọi theo tọa độ
+VIETNAM_CITIES = [
+    ("Hà Nội", 1581130, 21.0245, 105.8412),
+    ("Hồ Chí Minh", 1566083, 10.8231, 106.6297),
+    ("Đà Nẵng", 1583992, 16.0678, 108.2208),
+    ("Huế", 1580240, 16.4619, 107.5955),
+    ("Hải Phòng", 1581298, 20.8561, 106.6822),
+    ("Cần Thơ", 1586203, 10.0452, 105.7469),
+    ("Nha Trang", 1572151, 12.2451, 109.1943),
+    ("Đà Lạt", 1584071, 11.9465, 108.4419),
+    ("Vũng Tàu", 1562414, 10.3460, 107.0843),
+    ("Hạ Long", 1580410, 20.9511, 107.0734),
+    ("Hội An", 1580541, 15.8801, 108.3380),
+    ("Quy Nhơn", 1568574, 13.7765, 109.2237),
+    ("Vinh", 1562798, 18.6733, 105.6923),
+    ("Buôn Ma Thuột", 1586896, 12.6667, 108.0500),
+    ("Phan Thiết", 1571058, 10.9333, 108.1000),
+    ("Biên Hòa", 1587923, 10.9447, 106.8243),
+    ("Thanh Hóa", 1566166, 19.8000, 105.7667),
+    ("Sa Pa", 0, 22.3364, 103.8438),
+    ("Phú Quốc", 0, 10.2899, 103.9840),
+    ("Ninh Bình", 0, 20.2539, 105.9750),
+    ("Nam Định", 1573517, 20.4337, 106.1773),
+    ("Thái Nguyên", 1566319, 21.5928, 105.8442),
+    ("Pleiku", 1569684, 13.9833, 108.0000),
+    ("Cà Mau", 0, 9.1769, 105.1500),
+]
+
+# Tiền tố hành chính được bỏ đi khi tra tên ("thành phố Đà Lạt", "TP. Huế", "tỉnh Ninh Bình"), đã chuẩn hóa bằng name_key
+NAME_PREFIXES = ("thanh pho ", "tp ", "tinh ")
+
+
+class City(namedtuple("City", "id name lat lon")):
+    __slots__ = ()
+
+    @property
+    def key(self):
+        """Khóa cache của thành phố: giống nhau cho mọi cách viết tên."""
+        return f"id:{self.id}" if self.id else f"{self.lat:.3f},{self.lon:.3f}"
+
+
+def name_key(name):
+    """Bỏ dấu, viết thường, bỏ dấu câu và khoảng trắng thừa: "TP. Hà  Nội" -> "tp ha noi"."""
+    return " ".join(fold(unicodedata.normalize("NFC", name or "")).split())
+
+
+class CityIndex:
+    """
+    Bảng tra tên -> City chỉ gồm các array: id (int32), vĩ độ/kinh độ (float32), tên (UTF-8 nối liền + offset)
+    và cặp (hash của tên đã chuẩn hóa, số dòng) đã sắp xếp theo hash. Tên trùng với nhiều thành phố
+    (ví dụ "Paris" trong city.list) là tên mơ hồ: lookup trả về None để OpenWeatherMap tự chọn qua q=...
+    """
+
+    def __init__(self, records=(), aliases=(), pinned=0):
+        """
+        `records`: các (id, tên, vĩ độ, kinh độ[, mã quốc gia]); `pinned` dòng đầu (bảng có sẵn) thắng khi trùng tên
+        với các dòng sau thay vì làm tên thành mơ hồ. `aliases`: các (tên gọi khác, tên chuẩn) trỏ tới
+        thành phố đầu tiên có tên chuẩn đó.
+        """
+        self._ids = array.array("i")
+        self._lats = array.array("f")
+        self._lons = array.array("f")
+        self._name_offsets = array.array("I", [0])
+        names = bytearray()
+        entries = {}  # hash -> số dòng, hoặc -1 nếu nhiều thành phố trùng tên (hay trùng hash)
+        for row, (city_id, name, lat, lon, *_) in enumerate(records):
+            self._ids.append(city_id or 0)
+            self._lats.append(lat)
+            self._lons.append(lon)
+            names += name.encode()
+            self._name_offsets.append(len(names))
+            key_hash = hash(name_key(name))
+            if key_hash not in entries:
+                entries[key_hash] = row
+            elif entries[key_hash] >= pinned:
+                entries[key_hash] = -1
+        # Tên gọi khác ít nên để trong dict riêng (khóa đầy đủ, không cần so lại tên)
+        self._aliases = {}
+        for alias, canonical in aliases:
+            row = entries.get(hash(name_key(canonical)), -1)
+            if row >= 0:
+                self._aliases.setdefault(name_key(alias), row)
+        self._names = bytes(names)
+        self._hashes = array.array("q", sorted(entries))
+        self._rows = array.array("i", (entries[key_hash] for key_hash in self._hashes))
+
+    def __len__(self):
+        return len(self._ids)
+
+    def nbytes(self):
+        """Dung lượng dữ liệu của chỉ mục (byte)."""
+        arrays = (self._ids, self._lats, self._lons, self._name_offsets, self._hashes, self._rows)
+        return len(self._names) + sum(len(a) * a.itemsize for a in arrays)
+
+    def _name(self, row):
+        return self._names[self._name_offsets[row]:self._name_offsets[row + 1]].decode()
+
+    def _city(self, row):
+        return City(self._ids[row] or None, self._name(row), round(self._lats[row], 4), round(self._lons[row], 4))
+
+    def lookup(self, name):
+        """Tra đúng tên (hoặc tên gọi khác) của thành phố; None nếu không có hoặc tên mơ hồ."""
+        key = name_key(name)
+        if not key:
+            return None
+        row = self._aliases.get(key)
+        if row is not None:
+            return self._city(row)
+        key_hash = hash(key)
+        i = bisect.bisect_left(self._hashes, key_hash)
+        if i < len(self._hashes) and self._hashes[i] == key_hash:
+            row = self._rows[i]
+            # Chỉ có hash: so lại tên để hai tên khác nhau trùng hash không trả về nhầm thành phố
+            if row >= 0 and name_key(self._name(row)) == key:
+                return self._city(row)
+        return None
+
+    def resolve(self, text):
+        """
+        Như lookup, nếu không có thì bỏ tiền tố hành chính ("thành phố Đà Lạt", "TP. Huế") rồi tra lại.
+        Không đoán tên thành phố nằm giữa chuỗi: "Vĩnh Long" không phải Vinh, nên trả về None để gọi theo q=.
+        """
+        city = self.lookup(text)
+        if city is None:
+            key = name_key(text)
+            for prefix in NAME_PREFIXES:
+                if key.startswith(prefix):
+                    return self.lookup(key[len(prefix):])
+        return city
+
+
+def load_city_list(path):
+    """Đọc city.list.json hoặc city.list.json.gz của OpenWeatherMap thành các (id, tên, vĩ độ, kinh độ, mã quốc gia)."""
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        cities = json.load(f)
+    return [(c["id"], c["name"], c["coord"]["lat"], c["coord"]["lon"], c.get("country", "")) for c in cities]
+
+
+def build_city_index(city_list_path=None):
+    """
+    Bảng có sẵn (kèm tên gọi khác của intent_classifier) cộng với city.list của OpenWeatherMap nếu có.
+    Bảng có sẵn thắng khi trùng tên; tên trùng giữa các thành phố của city.list là tên mơ hồ (gọi theo q=...).
+    """
+    records = [(city_id, name, lat, lon, "VN") for name, city_id, lat, lon in VIETNAM_CITIES]
+    if city_list_path:
+        known_ids = {record[0] for record in records}
+        records += [record for record in load_city_list(city_list_path) if record[0] not in known_ids]
+    aliases = [(alias, canonical) for canonical, names in CITY_GAZETTEER for alias in names]
+    return CityIndex(records, aliases, pinned=len(VIETNAM_CITIES))
+
+
+_city_index = None
+
+
+def get_city_index():
+    """Chỉ mục dùng chung, dựng lần đầu khi cần (CITY_LIST_PATH đọc lúc đó)."""
+    global _city_index
+    if _city_index is None:
+        _city_index = build_city_index(os.getenv("CITY_LIST_PATH"))
+    return _city_index
+
+
+@lru_cache(maxsize=4096)
+def resolve_city(name):
+    """Trả về City (ID, tên chuẩn, tọa độ) cho tên thành phố, hoặc None nếu không có trong chỉ mục."""
+    return get_city_index().resolve(name)
@@ -0,0 +1,327 @@
+"""
+Bộ phân loại ý định cục bộ (không gọi LLM) cho các câu hỏi phổ biến.
+Dùng bảng từ khóa tiếng Việt đã bỏ dấu và danh bạ thành phố tra cứu không phân biệt dấu.
+Nếu độ tin cậy thấp, nơi gọi sẽ chuyển sang Gemini như bình thường.
+"""
+import re
+import unicodedata
+from functools import lru_cache
+
+# (tên chuẩn, các cách viết khác). Tất cả được bỏ dấu khi dựng bảng tra.
+CITY_GAZETTEER = [
+    ("Hà Nội", ["Hà Nội", "Hanoi"]),
+    ("Hồ Chí Minh", ["Hồ Chí Minh", "TP.HCM", "TPHCM", "HCM", "Sài Gòn", "Saigon", "thành phố Hồ Chí Minh"]),
+    ("Đà Nẵng", ["Đà Nẵng", "Danang"]),
+    ("Huế", ["Huế", "Thừa Thiên Huế"]),
+    ("Hải Phòng", ["Hải Phòng", "Haiphong"]),
+    ("Cần Thơ", ["Cần Thơ", "Cantho"]),
+    ("Nha Trang", ["Nha Trang", "Nhatrang"]),
+    ("Đà Lạt", ["Đà Lạt", "Dalat"]),
+    ("Vũng Tàu", ["Vũng Tàu", "Vungtau"]),
+    ("Hạ Long", ["Hạ Long", "Halong", "vịnh Hạ Long"]),
+    ("Hội An", ["Hội An", "Hoian", "phố cổ Hội An"]),
+    ("Quy Nhơn", ["Quy Nhơn", "Qui Nhơn", "Quynhon"]),
+    ("Vinh", ["TP Vinh", "thành phố Vinh"]),
+    ("Buôn Ma Thuột", ["Buôn Ma Thuột", "Buôn Mê Thuột", "Ban Mê Thuột"]),
+    ("Phan Thiết", ["Phan Thiết", "Mũi Né"]),
+    ("Biên Hòa", ["Biên Hòa", "Biên Hoà"]),
+    ("Thanh Hóa", ["Thanh Hóa", "Thanh Hoá"]),
+    ("Sa Pa", ["Sa Pa", "Sapa"]),
+    ("Phú Quốc", ["Phú Quốc", "Phu Quoc"]),
+    ("Ninh Bình", ["Ninh Bình"]),
+    ("Nam Định", ["Nam Định"]),
+    ("Thái Nguyên", ["Thái Nguyên"]),
+    ("Pleiku", ["Pleiku", "Plây Cu"]),
+    ("Cà Mau", ["Cà Mau"]),
+]
+
+# Địa danh ngoài danh bạ có tên bỏ dấu chứa tên một thành phố trong danh bạ ("Vĩnh Long" -> "vinh long" chứa "vinh").
+# Được tra như thành phố (khớp dài nhất trước) nhưng không có tên chuẩn, để câu hỏi được chuyển cho Gemini.
+OTHER_PLACES = [
+    "Vĩnh Long", "Vĩnh Yên", "Vĩnh Phúc", "Vĩnh Châu", "Vĩnh Linh", "Vĩnh Lộc", "Vĩnh Tường", "Vĩnh Thuận",
+    "Vĩnh Hy", "Vĩnh Hảo",
+]
+
+INTENT_CONFIDENCE_THRESHOLD = 0.8
+
+_NUMBER_WORDS = {"mot": 1, "hai": 2, "ba": 3, "bon": 4, "nam": 5, "sau": 6, "bay": 7}
+_MAX_CITY_TOKENS = 4
+
+_NAVIGATION = re.compile(
+    r"\b(?:chi duong|duong di|duong|tim duong|di|toi muon di|lam sao de di)\s+(?:den|toi|ra|vao)\s+(?P<place>.+)"
+)
+_FIND_ON_MAP = re.compile(r"\btim\s+(?P<place>.+?)\s+tren ban do\b")
+_PLACE_TAIL = re.compile(r"\s*(?:nhu the nao|the nao|o dau|di sao|bang cach nao|nhe|voi|a)?\s*$")
+# "đường vào Đà Lạt có sạt lở không": câu hỏi có/không về địa điểm, không phải hỏi đường
+_PLACE_QUESTION = re.compile(r"\b(?:co|bi|con|da|dang|duoc)\b.*\b(?:khong|chua)\b")
+_PLACE_RECOMMENDATION = re.compile(
+    r"\b(?:goi y dia diem|dia diem du lich|dia diem noi tieng|di dau choi|choi o dau|nen di dau|"
+    r"tham quan|diem den|co gi choi|choi gi|cho nao dep|dia diem vui choi)\b"
+)
+_CLOTHING = re.compile(r"\b(?:mac gi|mac ao|nen mac|trang phuc|ao khoac|mang ao|an mac|mac the nao|mac sao)\b")
+_NEXT_DAYS = re.compile(
+    r"\b(?P<num>\d+|mot|hai|ba|bon|nam|sau|bay)\s+ngay\s+(?:toi|nua|sau|ke tiep|tiep theo|sap toi)\b"
+)
+_VAGUE_NEXT_DAYS = re.compile(r"\b(?:nhung|may|vai|cac)\s+ngay\s+(?:toi|nua|sap toi|ke tiep|tiep theo)\b")
+_WEEK = re.compile(r"\btuan (?:nay|toi)\b")
+_TOMORROW = re.compile(r"\b(?:ngay mai|mai)\b")
+_WEATHER = re.compile(
+    r"\b(?:thoi tiet|nhiet do|troi|do am|du bao|bao nhieu do|gio bao|am u)\b"
+)
+# Từ khóa thời tiết trùng với từ khác sau khi bỏ dấu: "mua" là mưa/mua/mùa, "nang" là nắng/nặng...
+# Chỉ tính khi được viết đúng dấu; câu không dấu thì không chắc chắn (độ tin cậy dưới ngưỡng).
+_AMBIGUOUS_WEATHER = {"mua": "mưa", "nang": "nắng", "nong": "nóng", "lanh": "lạnh"}
+_AMBIGUOUS_WEATHER_PATTERN = re.compile(r"\b(?:" + "|".join(_AMBIGUOUS_WEATHER) + r")\b")
+_UNACCENTED_CONFIDENCE = 0.6
+# Thời điểm mà fast path không trả lời được (quá khứ, cuối tuần, một tháng/thứ cụ thể, tối nay...) và số liệu thống kê
+_OTHER_TIME = re.compile(
+    r"\b(?:hom qua|hom kia|tuan truoc|tuan sau|thang truoc|nam ngoai|nam truoc|cuoi tuan|chu nhat|"
+    r"thang (?:\d+|mot|hai|ba|tu|bon|nam|sau|bay|tam|chin|muoi|gieng|chap)|thu (?:\d|hai|ba|tu|nam|sau|bay)|"
+    r"toi nay|dem nay|chieu nay|trung binh|lich su)\b"
+)
+# "trời ơi đông quá": thán từ, không phải hỏi về trời
+_EXCLAMATION = re.compile(r"\b(?:troi oi|troi dat|troi a|ong troi)\b")
+# Hỏi mua bán ("mua áo khoác ở đâu", "giá bao nhiêu"); từ có dấu phải viết đúng dấu (mùa/mưa không phải mua)
+_SHOPPING = {"mua": "mua", "gia": "giá", "ban": "bán"}
+_SHOPPING_PATTERN = re.compile(r"\b(?:mua|gia(?! ret)|ban)\b|\b(?:cua hang|bao nhieu tien)\b")
+
+
+@lru_cache(maxsize=4096)
+def _fold_char(ch):
+    if ch in "đĐ":
+        return "d"
+    base = unicodedata.normalize("NFD", ch)[0].lower()
+    if len(base) != 1:
+        return " "
+    return base if base.isalnum() else " "
+
+
+def fold(text):
+    """Bỏ dấu, viết thường và thay dấu câu bằng khoảng trắng. Giữ nguyên độ dài chuỗi (NFC)."""
+    return "".join(_fold_char(ch) for ch in text)
+
+
+def _tokens(folded):
+    return [(m.group(), m.start(), m.end()) for m in re.finditer(r"[a-z0-9]+", folded)]
+
+
+def _build_city_index():
+    """
+    Trả về (bảng tên đã bỏ dấu -> tên chuẩn hoặc None với OTHER_PLACES,
+    bảng tên đã bỏ dấu -> các cách viết có dấu của từng từ, theo vị trí).
+    """
+    index = {}
+    spellings = {}
+    names = [(canonical, alias) for canonical, aliases in CITY_GAZETTEER for alias in [canonical] + aliases]
+    names += [(None, place) for place in OTHER_PLACES]
+    for canonical, alias in names:
+        alias = unicodedata.normalize("NFC", alias)
+        tokens = _tokens(fold(alias))
+        key = " ".join(token for token, _, _ in tokens)
+        index[key] = canonical
+        forms = spellings.setdefault(key, [set() for _ in tokens])
+        for position, (_, start, end) in enumerate(tokens):
+            forms[position].add(alias[start:end].casefold())
+    return index, spellings
+
+
+CITY_INDEX, _CITY_SPELLINGS = _build_city_index()
+
+
+def _matches_spelling(key, tokens, text):
+    """Từ nào được viết có dấu thì dấu phải đúng với tên trong danh bạ: "Vĩnh" không phải "Vinh"."""
+    for forms, (_, start, end) in zip(_CITY_SPELLINGS[key], tokens):
+        word = text[start:end]
+        if not word.isascii() and word.casefold() not in forms:
+            return False
+    return True
+
+
+def _continues_name(tokens, i, text):
+    """Từ ngay sau tên (viết hoa như tên riêng) cho thấy đây là một địa danh dài hơn, ví dụ "Vinh Quang"."""
+    if i >= len(tokens):
+        return False
+    _, start, _ = tokens[i]
+    return text[start].isupper()
+
+
+def _find_cities(text, folded):
+    """
+    Trả về danh sách (tên chuẩn, start, end) của các thành phố xuất hiện trong câu `text` (NFC),
+    tra trên chuỗi đã bỏ dấu `folded`. Tên chuẩn là None với địa danh trong OTHER_PLACES.
+    """
+    tokens = _tokens(folded)
+    found = []
+    i = 0
+    while i < len(tokens):
+        for n in range(min(_MAX_CITY_TOKENS, len(tokens) - i), 0, -1):
+            key = " ".join(token for token, _, _ in tokens[i:i + n])
+            if key in CITY_INDEX and _matches_spelling(key, tokens[i:i + n], text) \
+                    and not _continues_name(tokens, i + n, text):
+                found.append((CITY_INDEX[key], tokens[i][1], tokens[i + n - 1][2]))
+                i += n
+                break
+        else:
+            i += 1
+    return found
+
+
+def find_city(text):
+    """Tìm tên thành phố trong câu (không phân biệt dấu). Trả về tên chuẩn, hoặc None nếu không có/mơ hồ."""
+    text = unicodedata.normalize("NFC", text)
+    names = {name for name, _, _ in _find_cities(text, fold(text))}
+    return names.pop() if len(names) == 1 else None
+
+
+def _weather_keyword(question, keywords_only, start=0, end=None):
+    """
+    Tìm từ khóa thời tiết trong keywords_only[start:end]. Trả về độ tin cậy: 0.9 nếu chắc chắn,
+    _UNACCENTED_CONFIDENCE nếu chỉ có từ khóa dễ nhầm trong câu không dấu, 0.0 nếu không có.
+    """
+    end = len(keywords_only) if end is None else end
+    if _WEATHER.search(keywords_only, start, end):
+        return 0.9
+    unaccented = question.isascii()
+    for match in _AMBIGUOUS_WEATHER_PATTERN.finditer(keywords_only, start, end):
+        if unaccented:
+            return _UNACCENTED_CONFIDENCE
+        if question[match.start():match.end()].lower() == _AMBIGUOUS_WEATHER[match.group()]:
+            return 0.9
+    return 0.0
+
+
+def _is_shopping(question, keywords_only):
+    for match in _SHOPPING_PATTERN.finditer(keywords_only):
+        word = match.group()
+        if word not in _SHOPPING:
+            return True
+        if question[match.start():match.end()].lower() == _SHOPPING[word]:
+            # câu không dấu: chỉ "mua" (không phải "ban" = bạn, "gia" = gia đình), nhưng vẫn có thể là "mưa"
+            if not question.isascii() or word == "mua":
+                return True
+    return False
+
+
+def _extract_place(question, folded, keywords_only):
+    for pattern in (_NAVIGATION, _FIND_ON_MAP):
+        match = pattern.search(folded)
+        if match:
+            start, end = match.span("place")
+            tail = _PLACE_TAIL.search(folded, start, end)
+            if tail:
+                end = tail.start()
+            if _PLACE_QUESTION.search(folded, start, end):
+                return ""
+            # "đi Đà Lạt mặc gì", "đến Huế trời có mưa không" không phải câu hỏi đường
+            if any(p.search(keywords_only, start, end) for p in (_CLOTHING, _PLACE_RECOMMENDATION)) \
+                    or _weather_keyword(question, keywords_only, start, end):
+                return ""
+            return question[start:end].strip(" ?.!,")
+    return ""
+
+
+def _num_days(folded):
+    match = _NEXT_DAYS.search(folded)
+    if match:
+        num = match.group("num")
+        return int(num) if num.isdigit() else _NUMBER_WORDS[num], 0.9
+    if _WEEK.search(folded):
+        return 5, 0.85  # API dự báo miễn phí chỉ có 5 ngày
+    if _VAGUE_NEXT_DAYS.search(folded):
+        return 3, 0.85
+    return None, 0.0
+
+
+def classify(question):
+    """
+    Phân loại câu hỏi. Trả về (intent_details, confidence); intent_details có cùng dạng với
+    kết quả của analyze_user_intent_with_gemini. confidence = 0 nếu không nhận ra.
+    """
+    question = unicodedata.normalize("NFC", question.strip())
+    folded = fold(question)
+    cities = _find_cities(question, folded)
+    names = {name for name, _, _ in cities}
+    city = names.pop() if len(names) == 1 else None
+    details = {"city": city or "", "place_name": "", "intent": "unknown", "num_days": 1}
+
+    # Xóa tên thành phố trước khi dò từ khóa ("Đà Nẵng" chứa "nang", "Nam Định" chứa "nam").
+    # Độ dài chuỗi không đổi nên vị trí vẫn khớp với câu hỏi gốc.
+    keywords_only = folded
+    for _, start, end in cities:
+        keywords_only = keywords_only[:start] + " " * (end - start) + keywords_only[end:]
+
+    place_name = _extract_place(question, folded, keywords_only)
+    if place_name:
+        details.update(intent="specific_place_navigation", place_name=place_name,
+                       city=find_city(place_name) or city or "")
+        return details, 0.9
+    if not city:
+        return details, 0.0
+
+    if _PLACE_RECOMMENDATION.search(keywords_only):
+        details["intent"] = "place_recommendation"
+        return details, 0.9
+
+    # Các dấu hiệu cho thấy câu hỏi không thuộc intent nào dưới đây dù có từ khóa: để Gemini quyết định
+    if any(p.search(keywords_only) for p in (_OTHER_TIME, _EXCLAMATION)) or _is_shopping(question, keywords_only):
+        return details, 0.0
+
+    num_days, days_confidence = _num_days(keywords_only)
+    if _CLOTHING.search(keywords_only):
+        if num_days:
+            return details, 0.0
+        details["intent"] = "clothing_advice_tomorrow" if _TOMORROW.search(keywords_only) else "clothing_advice_today"
+        return details, 0.9
+    if num_days:
+        details.update(intent="forecast_next_days", num_days=num_days)
+        return details, days_confidence
+    confidence = _weather_keyword(question, keywords_only)
+    if confidence:
+        if _TOMORROW.search(keywords_only):
+            details["intent"] = "forecast_tomorrow"
+            return details, confidence
+        if "du bao" in keywords_only:
+            return details, 0.0
+        details["intent"] = "current_weather"
+        return details, confidence
+    return details, 0.0
+
+
+def guess_weather_type(question):
+    """Đoán loại dữ liệu thời tiết ("weather" hoặc "forecast") câu hỏi nhiều khả năng cần, để tải trước."""
+    folded = fold(unicodedata.normalize("NFC", question))
+    if "du bao" in folded or any(p.search(folded) for p in (_TOMORROW, _NEXT_DAYS, _VAGUE_NEXT_DAYS, _WEEK)):
+        return "forecast"
+    return "weather"
+
+
+class FastPathStats:
+    """Thống kê tỉ lệ câu hỏi xử lý cục bộ và thời gian tiết kiệm được so với gọi Gemini."""
+
+    def __init__(self):
+        self.fast_path_hits = 0
+        self.llm_fallbacks = 0
+        self.llm_latency_avg = None  # trung bình trượt (EMA) thời gian phân tích bằng Gemini, giây
+        self.saved_seconds = 0.0
+
+    def record_llm(self, seconds):
+        self.llm_fallbacks += 1
+        if self.llm_latency_avg is None:
+            self.llm_latency_avg = seconds
+        else:
+            self.llm_latency_avg = 0.9 * self.llm_latency_avg + 0.1 * seconds
+
+    def record_fast_path(self, seconds):
+        self.fast_path_hits += 1
+        if self.llm_latency_avg is not None:
+            self.saved_seconds += max(0.0, self.llm_latency_avg - seconds)
+
+    def stats(self):
+        total = self.fast_path_hits + self.llm_fallbacks
+        return {
+            "fast_path_hits": self.fast_path_hits,
+            "llm_fallbacks": self.llm_fallbacks,
+            "fast_path_hit_rate": self.fast_path_hits / total if total else 0.0,
+            "llm_latency_avg_ms": round(self.llm_latency_avg * 1000, 1) if self.llm_latency_avg is not None else None,
+            "latency_saved_ms": round(self.saved_seconds * 1000, 1),
+        }
@@ -1,70 +1,275 @@
+import asyncio
+import contextvars
+import json
+import math
 import os
-from fastapi import FastAPI, Query # Thêm Query để định nghĩa tham số tùy chọn
+import time
+from contextlib import aclosing, asynccontextmanager
+from fastapi import APIRouter, FastAPI, Query # Thêm Query để định nghĩa tham số tùy chọn
 from fastapi.middleware.cors import CORSMiddleware
-import requests
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field
 from dotenv import load_dotenv
-import google.generativeai as genai
-from datetime import datetime, timedelta
-import re
+from datetime import date, datetime, timedelta, timezone
 import urllib.parse
 
-# ... (Phần load_dotenv và khởi tạo Gemini, FastAPI giữ nguyên) ...
+import intent_classifier
+from backends import Services
+from city_index import get_city_index, name_key, resolve_city
+from metrics import REGISTRY
+from rate_limit import (LOW_PRIORITY_INTENTS, PRIORITY_HIGH, ClientRateLimiter, RateLimitedError, limiter_from_env,
+                        prepaid_tokens, release_prepaid, request_priority, set_request_priority)
+from request_plan import RequestPlan, tag_span
+from resilience import CircuitBreaker, CircuitOpenError, UpstreamPolicy
+from ttl_cache import SQLiteStore, TTLCache, normalize_key
+from weather_client import GROUP_MAX_IDS, RATE_LIMITED_MESSAGE
+
+# .env chỉ được đọc (rẻ); Gemini và client thời tiết được tạo lười qua `services` khi dùng lần đầu
 load_dotenv()
-google_ai_api_key = os.getenv("GOOGLE_AI_API_KEY")
-weather_api_key = os.getenv("OPENWEATHERMAP_API_KEY")
-
-if not google_ai_api_key:
-    print("Lỗi: GOOGLE_AI_API_KEY chưa được thiết lập trong file .env")
-    exit()
-if not weather_api_key:
-    print("Lỗi: OPENWEATHERMAP_API_KEY chưa được thiết lập trong file .env")
-    exit()
-
-genai.configure(api_key=google_ai_api_key)
-gemini_model = genai.GenerativeModel('gemini-1.5-flash-latest')
-
-app = FastAPI()
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+
+services = Services()
+
+def get_weather_client():
+    # Client (và connection pool) được tạo một lần, dùng chung cho mọi request
+    return services.weather
+
+@asynccontextmanager
+async def lifespan(app):
+    for key in services.missing_api_keys():
+        print(f"Cảnh báo: {key} chưa được thiết lập trong file .env")
+    if os.getenv("CITY_LIST_PATH"):
+        # Danh sách thành phố đầy đủ mất vài giây để nạp: dựng chỉ mục trước khi nhận request đầu tiên
+        await asyncio.to_thread(get_city_index)
+    llm_cache_path = os.getenv("LLM_CACHE_PATH")
+    if llm_cache_path:
+        # Mở file cache và nạp các mục còn hạn ở thread riêng, trước khi nhận request đầu tiên
+        for cache, table in LLM_CACHE_TABLES:
+            store = await asyncio.to_thread(SQLiteStore, llm_cache_path, table)
+            cache.attach_store(store, await asyncio.to_thread(store.load, cache.maxsize))
+    yield
+    for cache, _ in LLM_CACHE_TABLES:
+        await cache.flush()  # mục cache LLM còn chờ ghi xuống LLM_CACHE_PATH
+    await services.aclose()
+
+router = APIRouter()
+
+async def count_llm_calls(request, call_next):
+    # Header được gửi trước khi thân response chạy nên chỉ đúng với /ask; /ask/stream báo số lần gọi trong sự kiện "done"
+    counter = {"llm_calls": 0}
+    llm_call_counter.set(counter)
+    response = await call_next(request)
+    response.headers["X-LLM-Calls"] = str(counter["llm_calls"])
+    return response
+
+# Giới hạn số câu hỏi mỗi IP (CLIENT_RATE_LIMIT câu/phút, mặc định tắt); /stats và /metrics không bị giới hạn
+CLIENT_RATE_LIMIT = float(os.getenv("CLIENT_RATE_LIMIT", "0"))
+client_rate_limiter = ClientRateLimiter(
+    CLIENT_RATE_LIMIT, burst=float(os.getenv("CLIENT_RATE_BURST", "10")),
+) if CLIENT_RATE_LIMIT > 0 else None
+CLIENT_RATE_LIMITED_PATHS = ("/ask", "/batch")
+
+async def limit_client_rate(request, call_next):
+    if client_rate_limiter is not None and request.client and request.url.path.startswith(CLIENT_RATE_LIMITED_PATHS):
+        retry_after = client_rate_limiter.allow(request.client.host)
+        if retry_after:
+            REGISTRY.inc("client_rate_limit_rejections_total")
+            return JSONResponse(
+                {"message": "Bạn đang gửi quá nhiều câu hỏi, vui lòng thử lại sau giây lát."},
+                status_code=429, headers={"Retry-After": str(math.ceil(retry_after))},
+            )
+    return await call_next(request)
+
+def create_app(app_services=None):
+    """
+    Tạo ứng dụng FastAPI. Có thể truyền Services với backend giả (ví dụ StubLLMBackend,
+    StubWeatherClient) để chạy không cần API key; mỗi process chỉ dùng một bộ services.
+    """
+    global services
+    if app_services is not None:
+        services = app_services
+    app = FastAPI(lifespan=lifespan)
+    app.middleware("http")(count_llm_calls)
+    app.middleware("http")(limit_client_rate)
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+    app.include_router(router)
+    return app
+
+# Thời tiết hiện tại thay đổi vài phút một lần, dự báo 3 giờ một lần nên TTL khác nhau theo loại
+WEATHER_CACHE_TTL = {
+    "weather": float(os.getenv("OWM_CACHE_TTL_WEATHER", "600")),
+    "forecast": float(os.getenv("OWM_CACHE_TTL_FORECAST", "1800")),
+}
+# Khi OpenWeatherMap lỗi (hoặc đang bị ngắt mạch), trả bản cache đã hết hạn không quá OWM_CACHE_STALE_TTL giây
+weather_cache = TTLCache(
+    maxsize=int(os.getenv("OWM_CACHE_SIZE", "512")),
+    stale_ttl=float(os.getenv("OWM_CACHE_STALE_TTL", "21600")),
 )
-# --- HẾT PHẦN KHÔNG THAY ĐỔI ---
-
-def get_weather_data(city, api_key, type="weather"):
-    # ... (Giữ nguyên hàm này) ...
-    if type == "weather":
-        url = f"http://api.openweathermap.org/data/2.5/weather?q={city}&appid={api_key}&units=metric&lang=vi"
-    elif type == "forecast":
-        url = f"http://api.openweathermap.org/data/2.5/forecast?q={city}&appid={api_key}&units=metric&lang=vi"
-    else:
+
+def city_cache_key(city):
+    """
+    Khóa cache cho thành phố: city ID/tọa độ nếu tên có trong chỉ mục thành phố, để "Hà Nội", "Ha Noi"
+    và "Hanoi" dùng chung một mục cache và một lời gọi upstream; ngược lại là tên đã chuẩn hóa.
+    """
+    location = resolve_city(city)
+    return (location.key if location else normalize_key(city)), location
+
+async def get_weather_data(city, type="weather"):
+    # Gọi OpenWeatherMap qua client bất đồng bộ để không chặn event loop.
+    # Kết quả thành công được cache theo (thành phố, loại API); thành phố có trong chỉ mục được gọi theo ID/tọa độ.
+    if type not in WEATHER_CACHE_TTL:
         return None, "Loại API không hợp lệ"
+    location_key, location = city_cache_key(city)
+
+    async def load():
+        tag_span(cache="miss")
+        try:
+            client = get_weather_client()
+        except RuntimeError as e:  # Thiếu API key: báo lỗi cho request thay vì dừng cả server
+            return None, str(e)
+        return await client.get(city, type=type, location=location)
+
+    key = (location_key, type)
+    tag_span(cache="hit")  # load() đổi thành "miss" nếu request này phải gọi upstream
+    data, error = await weather_cache.get_or_load(
+        key,
+        load,
+        ttl=WEATHER_CACHE_TTL[type],
+        cacheable=lambda result: result[1] is None,
+    )
+    if error:
+        stale = weather_cache.get_stale(key)
+        if stale is not None:
+            (stale_data, _), expired_for = stale
+            tag_span(cache="stale")
+            return {**stale_data, "_stale_seconds": expired_for + WEATHER_CACHE_TTL[type]}, None
+    return data, error
+
+def stale_note(data):
+    """Ghi chú cho câu trả lời dùng dữ liệu cũ (xem get_weather_data)."""
+    stale_seconds = data.get("_stale_seconds")
+    if stale_seconds is None:
+        return ""
+    return f"\n(Dữ liệu được cập nhật cách đây khoảng {max(1, round(stale_seconds / 60))} phút do máy chủ thời tiết đang gặp sự cố.)"
+
+INTENTS = [
+    "current_weather", "clothing_advice_today", "forecast_tomorrow", "clothing_advice_tomorrow",
+    "forecast_next_days", "place_recommendation", "specific_place_navigation", "unknown",
+]
+
+# Schema JSON để Gemini trả về đủ các trường chỉ trong một lần gọi
+INTENT_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "city": {"type": "string"},
+        "place_name": {"type": "string"},
+        "intent": {"type": "string", "format": "enum", "enum": INTENTS},
+        "num_days": {"type": "integer"},
+    },
+    "required": ["city", "place_name", "intent", "num_days"],
+}
+
+# Bộ đếm số lần gọi LLM của request hiện tại (được middleware gắn vào header X-LLM-Calls)
+llm_call_counter = contextvars.ContextVar("llm_call_counter", default=None)
+
+def is_gemini_failure(exc):
+    """
+    Chỉ lỗi 5xx/Unavailable, 429 (mã HTTP trong `code` của google.api_core) và lỗi kết nối mới tính là Gemini hỏng
+    (timeout luôn tính); lỗi của riêng một prompt (400, InvalidArgument) hay thiếu API key thì không.
+    """
+    if isinstance(exc, ConnectionError):
+        return True
+    code = getattr(exc, "code", None)
+    return isinstance(code, int) and (code >= 500 or code == 429)
+
+# Gemini: deadline cho mỗi lời gọi và ngắt mạch khi lỗi liên tục; không tự thử lại vì mỗi lần gọi đều tốn quota
+gemini_policy = UpstreamPolicy(
+    "gemini",
+    deadline=float(os.getenv("GEMINI_DEADLINE", "20")),
+    is_failure=is_gemini_failure,
+    breaker=CircuitBreaker(
+        "gemini",
+        failure_threshold=int(os.getenv("GEMINI_BREAKER_FAILURES", "5")),
+        reset_timeout=float(os.getenv("GEMINI_BREAKER_RESET", "30")),
+    ),
+    # Hạn mức theo quota của Gemini, ví dụ GEMINI_RATE_LIMIT=15 cho gói miễn phí
+    limiter=limiter_from_env("gemini", "GEMINI", default_burst=5),
+)
+
+# Câu trả lời khi Gemini đang bị ngắt mạch hoặc hết hạn mức (lỗi của OWM dùng câu trả lời của WeatherClient)
+GEMINI_CIRCUIT_OPEN_MESSAGE = "Trợ lý AI đang tạm gián đoạn, vui lòng thử lại sau ít phút."
+GEMINI_RATE_LIMITED_MESSAGE = "Trợ lý AI đang nhận quá nhiều câu hỏi, vui lòng thử lại sau giây lát."
+
+def llm_call_status(exc):
+    if isinstance(exc, CircuitOpenError):
+        return "circuit_open"
+    if isinstance(exc, RateLimitedError):
+        return "rate_limited"
+    if isinstance(exc, asyncio.TimeoutError):
+        return "timeout"
+    return "error"
+
+def observe_llm_call(mode, start, status):
+    REGISTRY.observe("upstream_request_duration_seconds", time.perf_counter() - start,
+                     upstream="gemini", endpoint=mode, status=status)
+    tag_span(status=status)
+
+async def generate_content(prompt, **kwargs):
+    """Mọi lời gọi Gemini đều đi qua hàm này để không chặn event loop và để đếm số lần gọi."""
+    counter = llm_call_counter.get()
+    if counter is not None:
+        counter["llm_calls"] += 1
+    start = time.perf_counter()
+    status = "error"
+    try:
+        response = await gemini_policy.call(lambda: services.llm.generate_content_async(prompt, **kwargs))
+        status = "ok"
+        return response
+    except Exception as e:
+        status = llm_call_status(e)
+        raise
+    finally:
+        observe_llm_call("generate", start, status)
+
+async def stream_content(prompt, **kwargs):
+    """Gọi Gemini ở chế độ streaming và trả về từng đoạn text ngay khi nhận được."""
+    counter = llm_call_counter.get()
+    if counter is not None:
+        counter["llm_calls"] += 1
+    start = time.perf_counter()
+    status = "error"
     try:
-        r = requests.get(url)
-        r.raise_for_status()
-        return r.json(), None
-    except requests.exceptions.HTTPError as http_err:
-        if r.status_code == 404:
-            return None, f"Không tìm thấy thành phố '{city}'."
-        elif r.status_code == 401:
-            return None, "Lỗi xác thực API Key của OpenWeatherMap."
-        return None, f"Lỗi HTTP: {http_err} (mã lỗi: {r.status_code})"
-    except requests.exceptions.RequestException as req_err:
-        return None, f"Lỗi kết nối: {req_err}"
+        async with aclosing(gemini_policy.stream(lambda: services.llm.generate_content_async(prompt, stream=True, **kwargs))) as chunks:
+            async for chunk in chunks:
+                try:
+                    text = chunk.text
+                except ValueError: # đoạn không có nội dung văn bản (ví dụ bị chặn bởi bộ lọc an toàn)
+                    continue
+                if text:
+                    yield text
+        status = "ok"
     except Exception as e:
-        return None, f"Lỗi không xác định khi gọi API thời tiết: {e}"
+        status = llm_call_status(e)
+        raise
+    finally:
+        # Đo tới lúc nhận đoạn cuối cùng (hoặc lúc người dùng ngắt kết nối)
+        observe_llm_call("stream", start, status)
 
-def analyze_user_intent_with_gemini(question: str):
+async def analyze_user_intent_with_gemini(question: str):
     """
     Phân tích câu hỏi của người dùng để xác định ý định, thành phố và các thông tin khác.
+    Chỉ dùng một lần gọi Gemini với output JSON có cấu trúc.
     """
     prompt = f"""
     Bạn là một trợ lý AI phân tích câu hỏi.
     Hãy phân tích câu hỏi sau và trích xuất các thông tin:
-    1. city: Tên thành phố (Nếu có và rõ ràng, ví dụ "Huế" trong "Đại Nội Huế"). Nếu không có thành phố cụ thể trong câu hỏi nhưng có một địa điểm rõ ràng, để trống city.
-    2. place_name: Tên địa điểm cụ thể nếu người dùng muốn tìm hoặc hỏi đường đến (ví dụ: "Đại Nội Huế", "Hồ Gươm").
+    1. city: Tên thành phố. Nếu câu hỏi chỉ nêu một địa điểm thì suy ra thành phố chứa địa điểm đó (ví dụ "Huế" từ "Đại Nội Huế"). Nếu không xác định được, để chuỗi rỗng.
+    2. place_name: Tên địa điểm cụ thể nếu người dùng muốn tìm hoặc hỏi đường đến (ví dụ: "Đại Nội Huế", "Hồ Gươm"). Nếu không có, để chuỗi rỗng.
     3. intent: Mục đích của câu hỏi. Các giá trị có thể:
         - "current_weather": Hỏi thời tiết hiện tại.
         - "clothing_advice_today": Hỏi nên mặc gì hôm nay.
@@ -72,70 +277,72 @@ def analyze_user_intent_with_gemini(question: str):
         - "clothing_advice_tomorrow": Hỏi nên mặc gì ngày mai.
         - "forecast_next_days": Hỏi thời tiết nhiều ngày tới.
         - "place_recommendation": Hỏi gợi ý địa điểm du lịch/vui chơi chung chung ở một thành phố.
-        - "specific_place_navigation": Hỏi đường đi hoặc thông tin về một địa điểm CỤ THỂ (ví dụ: "chỉ đường đến Đại Nội Huế", "tìm Hồ Gươm trên bản đồ").
+        - "specific_place_navigation": Hỏi đường đi hoặc thông tin về một địa điểm CỤ THỂ (ví dụ: "chỉ đường đến Đại Nội Huế", "tìm Hồ Gươm trên bản đồ"). Khi đó place_name bắt buộc phải có.
         - "unknown": Nếu không thể xác định rõ ràng.
-    4. num_days: Số ngày muốn dự báo.
+    4. num_days: Số ngày muốn dự báo (mặc định 1).
 
     Câu hỏi: "{question}"
-
-    Trả lời theo định dạng sau (CHỈ TRẢ VỀ CHUỖI NÀY, KHÔNG GIẢI THÍCH GÌ THÊM):
-    CITY:[tên thành phố]
-    PLACE_NAME:[tên địa điểm]
-    INTENT:[ý định]
-    NUM_DAYS:[số ngày]
     """
     try:
-        response = gemini_model.generate_content(prompt)
-        analysis = response.text.strip()
-        # print(f"Gemini Raw Analysis:\n{analysis}") # Debug
-
-        city = (re.search(r"CITY:(.*)", analysis, re.IGNORECASE).group(1).strip()
-                if re.search(r"CITY:(.*)", analysis, re.IGNORECASE) else "")
-        place_name = (re.search(r"PLACE_NAME:(.*)", analysis, re.IGNORECASE).group(1).strip()
-                      if re.search(r"PLACE_NAME:(.*)", analysis, re.IGNORECASE) else "")
-        intent = (re.search(r"INTENT:(.*)", analysis, re.IGNORECASE).group(1).strip()
-                  if re.search(r"INTENT:(.*)", analysis, re.IGNORECASE) else "unknown")
-        num_days_match = re.search(r"NUM_DAYS:(\d*)", analysis, re.IGNORECASE)
-        num_days = int(num_days_match.group(1)) if num_days_match and num_days_match.group(1) else 1
-        
-        # Nếu intent là specific_place_navigation mà không có place_name, thử trích xuất lại place_name
-        if intent == "specific_place_navigation" and not place_name:
-            # Đơn giản là lấy toàn bộ câu hỏi làm place_name nếu nó không quá chung chung
-            # Hoặc dùng một prompt khác để trích xuất place_name kỹ hơn
-            # Ví dụ đơn giản:
-            if "đến" in question.lower():
-                 extracted_place = question.lower().split("đến", 1)[-1].strip()
-                 # Có thể cần làm sạch thêm
-                 place_name = extracted_place.replace("?", "").strip().title()
-
-
-        # Nếu có place_name nhưng không có city, thử trích xuất city từ place_name (ví dụ: "Đại Nội Huế" -> city "Huế")
-        if place_name and not city:
-            city_extract_prompt_from_place = f"Từ tên địa điểm '{place_name}', trích xuất tên thành phố nếu có. Nếu không rõ thành phố, trả về 'Không xác định'. Chỉ trả về tên thành phố."
-            city_response = gemini_model.generate_content(city_extract_prompt_from_place)
-            extracted_city = city_response.text.strip()
-            if extracted_city and extracted_city.lower() != "không xác định":
-                city = extracted_city
-        
-        # Nếu vẫn không có city và intent cần city (trừ place_recommendation và specific_place_navigation nếu đã có place_name)
-        # thì thử trích xuất city từ câu hỏi gốc.
-        if not city and intent not in ["unknown", "place_recommendation", "specific_place_navigation"] or \
-           (intent in ["place_recommendation", "specific_place_navigation"] and not place_name and not city):
-            city_extract_prompt = f"Trích xuất tên thành phố từ câu sau: \"{question}\". Chỉ trả về tên thành phố. Nếu không có, trả về 'Không xác định'."
-            city_response = gemini_model.generate_content(city_extract_prompt)
-            extracted_city_name = city_response.text.strip()
-            if extracted_city_name.lower() != "không xác định" and extracted_city_name:
-                city = extracted_city_name
-        
-        # print(f"Parsed: City='{city}', Place='{place_name}', Intent='{intent}'") # Debug
-        return {"city": city, "place_name": place_name, "intent": intent, "num_days": num_days}
-
+        response = await generate_content(
+            prompt,
+            generation_config={
+                "response_mime_type": "application/json",
+                "response_schema": INTENT_RESPONSE_SCHEMA,
+            },
+        )
+        return parse_intent_analysis(response.text)
+    except (CircuitOpenError, RateLimitedError):
+        raise  # resolve_intent báo người dùng thử lại thay vì trả lời "chưa hiểu"
     except Exception as e:
         print(f"Lỗi khi phân tích ý định bằng Gemini: {e}")
         return {"city": "", "place_name": "", "intent": "unknown", "num_days": 1}
 
+LOCAL_INTENT_CLASSIFIER = os.getenv("LOCAL_INTENT_CLASSIFIER", "1") == "1"
+intent_fast_path_stats = intent_classifier.FastPathStats()
+
+async def resolve_intent(question: str, plan=None):
+    """
+    Thử bộ phân loại cục bộ trước; chỉ gọi Gemini khi độ tin cậy thấp.
+    Nếu có `plan` và bộ phân loại cục bộ đã nhận ra thành phố, dữ liệu thời tiết được tải trước
+    song song với lúc chờ Gemini (request sau đó dùng lại qua cache/gộp request của get_weather_data).
+    Khi Gemini đang bị ngắt mạch hoặc hết hạn mức, kết quả có thêm "error" là câu trả lời mời thử lại.
+    """
+    start = time.perf_counter()
+    if LOCAL_INTENT_CLASSIFIER:
+        details, confidence = intent_classifier.classify(question)
+        if confidence >= intent_classifier.INTENT_CONFIDENCE_THRESHOLD:
+            intent_fast_path_stats.record_fast_path(time.perf_counter() - start)
+            tag_span(source="local")
+            return details
+        if plan is not None and details["city"]:
+            weather_type = intent_classifier.guess_weather_type(question)
+            plan.spawn(f"prefetch:{weather_type}", lambda: get_weather_data(details["city"], type=weather_type))
+    try:
+        details = await analyze_user_intent_with_gemini(question)
+    except CircuitOpenError:
+        details = {"city": "", "place_name": "", "intent": "unknown", "num_days": 1, "error": GEMINI_CIRCUIT_OPEN_MESSAGE}
+    except RateLimitedError:
+        details = {"city": "", "place_name": "", "intent": "unknown", "num_days": 1, "error": GEMINI_RATE_LIMITED_MESSAGE}
+    intent_fast_path_stats.record_llm(time.perf_counter() - start)
+    tag_span(source="llm")
+    return details
+
+def parse_intent_analysis(text):
+    analysis = json.loads(text)
+    intent = analysis.get("intent") or "unknown"
+    try:
+        num_days = int(analysis.get("num_days") or 1)
+    except (TypeError, ValueError):
+        num_days = 1
+    return {
+        "city": (analysis.get("city") or "").strip(),
+        "place_name": (analysis.get("place_name") or "").strip(),
+        "intent": intent if intent in INTENTS else "unknown",
+        "num_days": num_days,
+    }
+
 
-# ... (format_current_weather, format_daily_forecast, get_clothing_advice giữ nguyên) ...
 def format_current_weather(data, city_name_override=None):
     main_data = data.get("main")
     weather_list = data.get("weather")
@@ -152,107 +359,252 @@ def format_current_weather(data, city_name_override=None):
     if temp is None or desc is None:
         return f"Không thể lấy thông tin nhiệt độ hoặc mô tả cho {display_city_name}.", None
     weather_info_for_clothing = {"temp": temp, "feels_like": feels_like, "description": desc, "humidity": humidity, "icon": icon}
-    return (f"Hiện tại ở {display_city_name}: {desc}, nhiệt độ {temp}°C (cảm giác như {feels_like}°C), độ ẩm {humidity}%.", weather_info_for_clothing)
+    return (f"Hiện tại ở {display_city_name}: {desc}, nhiệt độ {temp}°C (cảm giác như {feels_like}°C), độ ẩm {humidity}%.{stale_note(data)}", weather_info_for_clothing)
+
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
 
-intent_details_holder = {}
+def aggregate_forecast(forecast_data):
+    """
+    Gộp các mốc dự báo 3 giờ thành tóm tắt theo ngày (theo giờ địa phương của thành phố) trong một lượt duyệt:
+    nhiệt độ thấp/cao nhất, độ ẩm trung bình, mô tả và icon xuất hiện nhiều nhất.
+    Kết quả được lưu vào chính payload (khóa "_daily_summary") nên payload đã cache chỉ phải gộp một lần
+    dù được nhiều intent dùng lại.
+    """
+    summary = forecast_data.get("_daily_summary")
+    if summary is not None:
+        return summary
+    tz_offset = forecast_data.get("city", {}).get("timezone", 0)
+    days = {}  # số ngày kể từ epoch -> [min, max, tổng độ ẩm, số mốc, {mô tả: số lần}, {icon: số lần}]
+    for item in forecast_data["list"]:
+        day = (item["dt"] + tz_offset) // 86400
+        main_data = item["main"]
+        weather = item["weather"][0]
+        temp = main_data["temp"]
+        acc = days.get(day)
+        if acc is None:
+            acc = days[day] = [temp, temp, 0, 0, {}, {}]
+        elif temp < acc[0]:
+            acc[0] = temp
+        elif temp > acc[1]:
+            acc[1] = temp
+        acc[2] += main_data["humidity"]
+        acc[3] += 1
+        descriptions, icons = acc[4], acc[5]
+        descriptions[weather["description"]] = descriptions.get(weather["description"], 0) + 1
+        icons[weather["icon"]] = icons.get(weather["icon"], 0) + 1
+    summary = [
+        {
+            "date": date.fromordinal(EPOCH_ORDINAL + day),
+            "temp_min": acc[0],
+            "temp_max": acc[1],
+            "humidity": acc[2] / acc[3],
+            "description": max(acc[4], key=acc[4].get),
+            "icon": max(acc[5], key=acc[5].get),
+        }
+        for day, acc in sorted(days.items())
+    ]
+    forecast_data["_daily_summary"] = summary
+    return summary
+
+def city_today(forecast_data):
+    tz_offset = forecast_data.get("city", {}).get("timezone", 0)
+    return (datetime.now(timezone.utc) + timedelta(seconds=tz_offset)).date()
 
-def format_daily_forecast(forecast_data, num_days, city_name_override=None):
+def format_daily_forecast(forecast_data, num_days, intent, city_name_override=None):
     if 'list' not in forecast_data:
         return "Không có dữ liệu dự báo.", None
-    daily_summary = {}
     city_name_from_api = forecast_data.get("city", {}).get("name", "Thành phố này")
     display_city_name = city_name_override if city_name_override else city_name_from_api
-    current_intent_details = intent_details_holder.get("details", {})
-    for item in forecast_data['list']:
-        date_txt = item['dt_txt'].split(' ')[0]
-        if len(daily_summary) >= num_days and date_txt not in daily_summary:
-            if num_days == 1 and datetime.strptime(date_txt, "%Y-%m-%d").date() > (datetime.now() + timedelta(days=1)).date(): break
-            elif len(daily_summary) >= num_days: break
-        if date_txt not in daily_summary:
-            if datetime.strptime(date_txt, "%Y-%m-%d").date() == datetime.now().date():
-                if num_days == 1 and current_intent_details.get("intent") in ["forecast_tomorrow", "clothing_advice_tomorrow"]: continue
-            daily_summary[date_txt] = {'temps': [], 'feels_like_temps': [], 'humidity': [], 'descriptions': {}, 'icons': {}}
-        daily_summary[date_txt]['temps'].append(item['main']['temp'])
-        daily_summary[date_txt]['feels_like_temps'].append(item['main']['feels_like'])
-        daily_summary[date_txt]['humidity'].append(item['main']['humidity'])
-        desc = item['weather'][0]['description']
-        icon = item['weather'][0]['icon']
-        daily_summary[date_txt]['descriptions'][desc] = daily_summary[date_txt]['descriptions'].get(desc, 0) + 1
-        daily_summary[date_txt]['icons'][icon] = daily_summary[date_txt]['icons'].get(icon, 0) + 1
+    today = city_today(forecast_data)
+    tomorrow = today + timedelta(days=1)
+    days = aggregate_forecast(forecast_data)
+    if intent in ["forecast_tomorrow", "clothing_advice_tomorrow", "forecast_next_days"]:
+        days = [day for day in days if day["date"] > today]
     output_str = f"Dự báo thời tiết cho {display_city_name}:\n"
     weather_for_clothing_tomorrow = None
     processed_days_count = 0
-    sorted_dates = sorted(daily_summary.keys())
-    for date_str in sorted_dates:
-        if processed_days_count >= num_days: break
-        current_date_obj = datetime.now().date()
-        forecast_date_obj = datetime.strptime(date_str, "%Y-%m-%d").date()
-        if current_intent_details.get("intent") in ["forecast_tomorrow", "clothing_advice_tomorrow"] and forecast_date_obj <= current_date_obj: continue
-        if current_intent_details.get("intent") == "forecast_next_days" and forecast_date_obj <= current_date_obj: continue
-        day_data = daily_summary[date_str]
-        if not day_data['temps']: continue
-        min_temp, max_temp = min(day_data['temps']), max(day_data['temps'])
-        avg_humidity = sum(day_data['humidity']) / len(day_data['humidity'])
-        common_desc = max(day_data['descriptions'], key=day_data['descriptions'].get)
-        common_icon = max(day_data['icons'], key=day_data['icons'].get)
-        formatted_date = datetime.strptime(date_str, "%Y-%m-%d").strftime("%d/%m")
+    for day in days[:num_days]:
+        formatted_date = day["date"].strftime("%d/%m")
         date_label = formatted_date
-        if forecast_date_obj == (datetime.now() + timedelta(days=1)).date():
+        if day["date"] == tomorrow:
             date_label = "Ngày mai (" + formatted_date + ")"
-            weather_for_clothing_tomorrow = {"temp_min": min_temp, "temp_max": max_temp, "description": common_desc, "humidity": avg_humidity, "icon": common_icon}
-        output_str += f"- {date_label}: {common_desc}, nhiệt độ từ {min_temp:.1f}°C - {max_temp:.1f}°C, độ ẩm khoảng {avg_humidity:.0f}%.\n"
-        processed_days_count +=1
-        if num_days == 1 and weather_for_clothing_tomorrow: break
-    if not weather_for_clothing_tomorrow and num_days == 1 and current_intent_details.get("intent") in ["clothing_advice_tomorrow", "forecast_tomorrow"]:
+            weather_for_clothing_tomorrow = {key: day[key] for key in ("temp_min", "temp_max", "description", "humidity", "icon")}
+        output_str += f"- {date_label}: {day['description']}, nhiệt độ từ {day['temp_min']:.1f}°C - {day['temp_max']:.1f}°C, độ ẩm khoảng {day['humidity']:.0f}%.\n"
+        processed_days_count += 1
+    if not weather_for_clothing_tomorrow and num_days == 1 and intent in ["clothing_advice_tomorrow", "forecast_tomorrow"]:
         return f"Rất tiếc, tôi chưa có đủ dữ liệu dự báo chi tiết cho ngày mai tại {display_city_name}. Vui lòng thử lại sau.", None
     if processed_days_count == 0 and num_days > 0 :
          return f"Không có dữ liệu dự báo cho những ngày tới tại {display_city_name}.", None
-    return output_str.strip(), weather_for_clothing_tomorrow
+    return output_str.strip() + stale_note(forecast_data), weather_for_clothing_tomorrow
 
-def get_clothing_advice(weather_info, day_description="hôm nay"):
-    if not weather_info: return "Không có thông tin thời tiết để đưa ra lời khuyên."
-    temp_desc = ""
+# Kết quả từ Gemini cho trang phục/gợi ý địa điểm gần như không đổi với cùng đầu vào nên được cache lâu.
+# Đặt LLM_CACHE_PATH (ví dụ llm_cache.sqlite3) để cache được lưu lại qua các lần khởi động (file được mở trong lifespan).
+clothing_advice_cache = TTLCache(
+    maxsize=1024, ttl=float(os.getenv("CLOTHING_ADVICE_CACHE_TTL", "86400")), clock=time.time,
+)
+place_recommendations_cache = TTLCache(
+    maxsize=512, ttl=float(os.getenv("PLACE_RECOMMENDATIONS_CACHE_TTL", "604800")), clock=time.time,
+)
+LLM_CACHE_TABLES = ((clothing_advice_cache, "clothing_advice"), (place_recommendations_cache, "place_recommendations"))
+
+# Nhóm điều kiện thời tiết theo 2 chữ số đầu của mã icon OpenWeatherMap
+WEATHER_CONDITION_CLASSES = {
+    "01": "trời quang", "02": "ít mây", "03": "nhiều mây", "04": "nhiều mây", "09": "mưa rào",
+    "10": "mưa", "11": "dông", "13": "tuyết", "50": "sương mù",
+}
+
+def quantize_weather_state(weather_info, day_label):
+    """Lượng tử hóa thông tin thời tiết thành khóa cache: khoảng nhiệt độ 2°C, độ ẩm làm tròn 10%, nhóm thời tiết."""
     if "temp_min" in weather_info and "temp_max" in weather_info:
-        temp_desc = f"nhiệt độ dao động từ {weather_info['temp_min']:.1f}°C đến {weather_info['temp_max']:.1f}°C"
-    elif "temp" in weather_info:
-        temp_desc = f"nhiệt độ khoảng {weather_info['temp']:.1f}°C"
-        if "feels_like" in weather_info: temp_desc += f" (cảm giác như {weather_info['feels_like']:.1f}°C)"
-    description = weather_info.get('description', 'không rõ')
-    humidity = weather_info.get('humidity')
-    humidity_desc = f", độ ẩm {humidity:.0f}%" if humidity else ""
-    prompt = f"""Bạn là một stylist AI thân thiện. Dựa vào thông tin thời tiết sau, hãy đưa ra lời khuyên nên mặc gì. Thời tiết {day_description}: {description}, {temp_desc}{humidity_desc}. Hãy đưa ra gợi ý cụ thể. Lời khuyên của bạn:"""
+        temp_low, temp_high = weather_info["temp_min"], weather_info["temp_max"]
+    else:
+        feels_like = weather_info.get("feels_like")
+        temp_low = temp_high = feels_like if feels_like is not None else weather_info["temp"]
+    temp_low = int(temp_low // 2 * 2)
+    temp_high = int(temp_high // 2 * 2 + 2)
+    humidity = weather_info.get("humidity")
+    humidity = int(round(humidity / 10) * 10) if humidity else None
+    icon = weather_info.get("icon") or ""
+    condition = WEATHER_CONDITION_CLASSES.get(icon[:2]) or normalize_key(weather_info.get("description", "không rõ"))
+    return (temp_low, temp_high, humidity, condition, day_label)
+
+def clothing_advice_prompt(temp_low, temp_high, humidity, condition, day_label):
+    # Prompt chỉ dùng giá trị đã lượng tử hóa để lời khuyên đúng cho mọi request cùng khóa cache
+    humidity_desc = f", độ ẩm khoảng {humidity}%" if humidity else ""
+    return f"""Bạn là một stylist AI thân thiện. Dựa vào thông tin thời tiết sau, hãy đưa ra lời khuyên nên mặc gì. Thời tiết {day_label}: {condition}, nhiệt độ khoảng {temp_low}°C - {temp_high}°C{humidity_desc}. Hãy đưa ra gợi ý cụ thể. Lời khuyên của bạn:"""
+
+async def get_clothing_advice(weather_info, day_label="hôm nay"):
+    if not weather_info: return "Không có thông tin thời tiết để đưa ra lời khuyên."
+    key = quantize_weather_state(weather_info, day_label)
+    tag_span(cache="hit")
+    advice = await clothing_advice_cache.get_or_load(key, lambda: _generate_clothing_advice(key))
+    return advice or "Xin lỗi, tôi không thể đưa ra lời khuyên về trang phục lúc này."
+
+async def _generate_clothing_advice(key):
+    tag_span(cache="miss")
     try:
-        response = gemini_model.generate_content(prompt)
-        return response.text.strip()
+        response = await generate_content(clothing_advice_prompt(*key))
+        return response.text.strip() or None
     except Exception as e:
         print(f"Lỗi khi lấy lời khuyên từ Gemini: {e}")
-        return "Xin lỗi, tôi không thể đưa ra lời khuyên về trang phục lúc này."
+        return None
 
-def get_place_recommendations_from_gemini(city_name: str):
-    # ... (Giữ nguyên hàm này) ...
+async def stream_clothing_advice(weather_info, day_label="hôm nay"):
+    """Như get_clothing_advice nhưng trả về từng đoạn lời khuyên ngay khi Gemini sinh ra."""
+    if not weather_info:
+        yield "Không có thông tin thời tiết để đưa ra lời khuyên."
+        return
+    key = quantize_weather_state(weather_info, day_label)
+    advice = clothing_advice_cache.lookup(key)
+    tag_span(cache="miss" if advice is None else "hit")
+    if advice is not None:
+        yield advice
+        return
+    parts = []
+    try:
+        async for text in stream_content(clothing_advice_prompt(*key)):
+            parts.append(text)
+            yield text
+    except Exception as e:
+        print(f"Lỗi khi lấy lời khuyên từ Gemini: {e}")
+        if not parts:
+            yield "Xin lỗi, tôi không thể đưa ra lời khuyên về trang phục lúc này."
+        return
+    if "".join(parts).strip():
+        clothing_advice_cache.set(key, "".join(parts).strip())
+
+def place_recommendations_prompt(city_name):
+    return f"""Bạn là một hướng dẫn viên du lịch AI. Hãy gợi ý từ 3 đến 5 địa điểm du lịch, tham quan hoặc vui chơi nổi tiếng ở thành phố "{city_name}". Liệt kê mỗi địa điểm trên một dòng mới. Chỉ trả về tên các địa điểm, không thêm mô tả hay đánh số."""
+
+def is_no_recommendation(text):
+    text = text.lower()
+    return "không tìm thấy thông tin" in text or "không có gợi ý" in text
+
+def place_recommendations_header_html(city_name):
+    return f"<p>Dưới đây là một số gợi ý địa điểm ở {city_name} bạn có thể tham khảo:</p>\n<ul>\n"
+
+def place_item_html(city_name, clean_name):
+    encoded_name = urllib.parse.quote_plus(clean_name)
+    map_link = f"https://www.google.com/maps/search/?api=1&query={encoded_name}+{urllib.parse.quote_plus(city_name)}"
+    return f'  <li><a href="{map_link}" target="_blank" rel="noopener noreferrer">{clean_name}</a></li>\n'
+
+async def get_place_recommendations_from_gemini(city_name: str):
     if not city_name:
         return "Vui lòng cung cấp tên thành phố để tôi có thể gợi ý địa điểm."
-    prompt = f"""Bạn là một hướng dẫn viên du lịch AI. Hãy gợi ý từ 3 đến 5 địa điểm du lịch, tham quan hoặc vui chơi nổi tiếng ở thành phố "{city_name}". Liệt kê mỗi địa điểm trên một dòng mới. Chỉ trả về tên các địa điểm, không thêm mô tả hay đánh số."""
+    tag_span(cache="hit")
+    place_names = await place_recommendations_cache.get_or_load(
+        city_cache_key(city_name)[0], lambda: _fetch_place_names(city_name), cacheable=bool,
+    )
+    if place_names is None:
+        return f"Xin lỗi, tôi gặp sự cố khi tìm kiếm gợi ý địa điểm cho {city_name}."
+    if not place_names:
+        return f"Xin lỗi, tôi không tìm thấy gợi ý địa điểm nào cho {city_name} vào lúc này."
+    html_output = place_recommendations_header_html(city_name)
+    for clean_name in place_names:
+        html_output += place_item_html(city_name, clean_name)
+    html_output += "</ul>"
+    return html_output
+
+async def _fetch_place_names(city_name):
+    """Trả về danh sách tên địa điểm, [] nếu Gemini không có gợi ý, None nếu lỗi."""
+    tag_span(cache="miss")
     try:
-        response = gemini_model.generate_content(prompt)
+        response = await generate_content(place_recommendations_prompt(city_name))
         place_names_text = response.text.strip()
-        if not place_names_text or "không tìm thấy thông tin" in place_names_text.lower() or "không có gợi ý" in place_names_text.lower():
-             return f"Xin lỗi, tôi không tìm thấy gợi ý địa điểm nào cho {city_name} vào lúc này."
-        place_names = [name.strip() for name in place_names_text.split('\n') if name.strip()]
-        if not place_names:
-            return f"Xin lỗi, tôi không thể đưa ra gợi ý địa điểm cụ thể cho {city_name}."
-        html_output = f"<p>Dưới đây là một số gợi ý địa điểm ở {city_name} bạn có thể tham khảo:</p>\n<ul>\n"
-        for name in place_names:
-            clean_name = name.replace("*", "").strip()
-            if not clean_name: continue
-            encoded_name = urllib.parse.quote_plus(clean_name)
-            map_link = f"https://www.google.com/maps/search/?api=1&query={encoded_name}+{urllib.parse.quote_plus(city_name)}"
-            html_output += f'  <li><a href="{map_link}" target="_blank" rel="noopener noreferrer">{clean_name}</a></li>\n'
-        html_output += "</ul>"
-        return html_output
     except Exception as e:
         print(f"Lỗi khi lấy gợi ý địa điểm từ Gemini cho {city_name}: {e}")
-        return f"Xin lỗi, tôi gặp sự cố khi tìm kiếm gợi ý địa điểm cho {city_name}."
+        return None
+    if not place_names_text or is_no_recommendation(place_names_text):
+        return []
+    place_names = [name.replace("*", "").strip() for name in place_names_text.split('\n')]
+    return [name for name in place_names if name]
+
+async def stream_place_recommendations(city_name: str):
+    """Trả về HTML gợi ý địa điểm theo từng dòng: mỗi địa điểm được gửi ngay khi Gemini sinh xong dòng đó."""
+    if not city_name:
+        yield "Vui lòng cung cấp tên thành phố để tôi có thể gợi ý địa điểm."
+        return
+    key, _ = city_cache_key(city_name)
+    cached = place_recommendations_cache.lookup(key)
+    tag_span(cache="miss" if cached is None else "hit")
+    if cached is not None:
+        yield place_recommendations_header_html(city_name) + "".join(place_item_html(city_name, name) for name in cached) + "</ul>"
+        return
+    place_names = []
+    buffer = ""
+    try:
+        async for text in stream_content(place_recommendations_prompt(city_name)):
+            buffer += text
+            *lines, buffer = buffer.split("\n")
+            for line in lines:
+                clean_name = line.replace("*", "").strip()
+                if not clean_name:
+                    continue
+                if not place_names and is_no_recommendation(clean_name):
+                    yield f"Xin lỗi, tôi không tìm thấy gợi ý địa điểm nào cho {city_name} vào lúc này."
+                    return
+                if not place_names:
+                    yield place_recommendations_header_html(city_name)
+                place_names.append(clean_name)
+                yield place_item_html(city_name, clean_name)
+    except Exception as e:
+        print(f"Lỗi khi lấy gợi ý địa điểm từ Gemini cho {city_name}: {e}")
+        if place_names:
+            yield "</ul>"
+        else:
+            yield f"Xin lỗi, tôi gặp sự cố khi tìm kiếm gợi ý địa điểm cho {city_name}."
+        return
+    clean_name = buffer.replace("*", "").strip()
+    if clean_name and not (not place_names and is_no_recommendation(clean_name)):
+        if not place_names:
+            yield place_recommendations_header_html(city_name)
+        place_names.append(clean_name)
+        yield place_item_html(city_name, clean_name)
+    if not place_names:
+        yield f"Xin lỗi, tôi không tìm thấy gợi ý địa điểm nào cho {city_name} vào lúc này."
+        return
+    yield "</ul>"
+    place_recommendations_cache.set(key, place_names)
 
 def get_navigation_link_html(destination_place: str, city_context: str = "", user_lat: float = None, user_lon: float = None):
     """
@@ -261,11 +613,20 @@ def get_navigation_link_html(destination_place: str, city_context: str = "", use
     if not destination_place:
         return "Vui lòng cung cấp địa điểm bạn muốn đến."
 
-    # Kết hợp destination_place và city_context để tìm kiếm chính xác hơn
-    full_destination_query = destination_place
-    if city_context and city_context.lower() not in destination_place.lower(): # Tránh lặp lại tên thành phố
-        full_destination_query += f", {city_context}"
-    
+    destination_city = get_city_index().lookup(destination_place)
+    if destination_city is not None:
+        # Đích là cả một thành phố: dùng tọa độ từ chỉ mục thành phố (cùng tọa độ dùng để lấy thời tiết)
+        full_destination_query = f"{destination_city.lat},{destination_city.lon}"
+    else:
+        # Kết hợp destination_place và tên chuẩn của city_context để tìm kiếm chính xác hơn
+        full_destination_query = destination_place
+        context_city = resolve_city(city_context) if city_context else None
+        city_name = context_city.name if context_city else city_context
+        # Tránh lặp lại tên thành phố (so sánh không dấu, kể cả tên gọi khác như "Sài Gòn" trong "chợ Bến Thành Sài Gòn")
+        if city_name and (context_city is None or intent_classifier.find_city(destination_place) != context_city.name) \
+                and name_key(city_name) not in name_key(destination_place):
+            full_destination_query += f", {city_name}"
+
     encoded_destination = urllib.parse.quote_plus(full_destination_query)
 
     if user_lat is not None and user_lon is not None:
@@ -290,124 +651,436 @@ def get_navigation_link_html(destination_place: str, city_context: str = "", use
     return html_output
 
 
-@app.get("/ask")
+@router.get("/stats/cache")
+async def cache_stats():
+    return {
+        "weather": weather_cache.stats(),
+        "clothing_advice": clothing_advice_cache.stats(),
+        "place_recommendations": place_recommendations_cache.stats(),
+    }
+
+
+@router.get("/stats/intent")
+async def intent_stats():
+    return intent_fast_path_stats.stats()
+
+
+@router.get("/stats/upstream")
+async def upstream_stats():
+    """Trạng thái circuit breaker của từng upstream."""
+    stats = {"gemini": gemini_policy.breaker.stats()}
+    try:
+        weather_policy = getattr(get_weather_client(), "policy", None)
+    except RuntimeError:
+        weather_policy = None
+    if weather_policy is not None:
+        stats["owm"] = weather_policy.breaker.stats()
+    return stats
+
+
+@router.get("/stats/rate_limit")
+async def rate_limit_stats():
+    """Token còn lại, số lời gọi đang chờ, đã cấp và bị từ chối theo độ ưu tiên của từng upstream."""
+    stats = {}
+    try:
+        weather_policy = getattr(get_weather_client(), "policy", None)
+    except RuntimeError:
+        weather_policy = None
+    for name, policy in (("owm", weather_policy), ("gemini", gemini_policy)):
+        if policy is not None and policy.limiter is not None:
+            stats[name] = policy.limiter.stats()
+    if client_rate_limiter is not None:
+        stats["clients"] = {"rejected": client_rate_limiter.rejected}
+    return stats
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Histogram độ trễ của request, từng bước và từng lời gọi upstream theo định dạng Prometheus."""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
+# Đặt SLOW_REQUEST_MS để ghi log các request chậm hơn ngưỡng (ms) kèm thời gian từng bước
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "0"))
+
+REGISTRY.describe("ask_request_duration_seconds", "Thời gian xử lý trọn một câu hỏi")
+REGISTRY.describe("ask_stage_duration_seconds", "Thời gian từng bước của câu hỏi (intent, owm, format, gemini)")
+REGISTRY.describe("upstream_request_duration_seconds", "Thời gian mỗi lời gọi OpenWeatherMap/Gemini")
+
+def record_request_metrics(plan, endpoint, question):
+    intent = plan.tags.get("intent", "none")
+    elapsed = plan.elapsed()
+    REGISTRY.observe("ask_request_duration_seconds", elapsed, endpoint=endpoint, intent=intent)
+    for name, start, end, _, tags in plan.spans:
+        # "owm:weather#2" và "owm:weather" là cùng một loại bước
+        REGISTRY.observe("ask_stage_duration_seconds", end - start, stage=name.split("#")[0], intent=intent, **tags)
+    if SLOW_REQUEST_MS and elapsed * 1000 >= SLOW_REQUEST_MS:
+        print(f"Request chậm: {json.dumps({'endpoint': endpoint, 'question': question, **plan.trace()}, ensure_ascii=False)}")
+
+
+@router.get("/ask")
 async def ask_weather_agent(
     question: str,
     user_lat: float = Query(None, alias="latitude"), # Nhận latitude từ query param
-    user_lon: float = Query(None, alias="longitude") # Nhận longitude từ query param
+    user_lon: float = Query(None, alias="longitude"), # Nhận longitude từ query param
+    trace: bool = False # Trả kèm timeline các bước và đường găng của request
 ):
-    global intent_details_holder
+    plan = RequestPlan()
+    prepaid = {}
+    prepaid_tokens.set(prepaid)
+    try:
+        message = "".join([part async for part in answer_question(question, user_lat, user_lon, plan=plan)])
+    finally:
+        release_prepaid(prepaid)  # kể cả khi answer_question lỗi
+    record_request_metrics(plan, "/ask", question)
+    if trace:
+        return {"message": message, "trace": plan.trace()}
+    return {"message": message}
+
+
+@router.get("/ask/stream")
+async def ask_weather_agent_stream(
+    question: str,
+    user_lat: float = Query(None, alias="latitude"),
+    user_lon: float = Query(None, alias="longitude"),
+    trace: bool = False
+):
+    """
+    Giống /ask nhưng trả về Server-Sent Events: phần thời tiết được gửi ngay khi có,
+    phần do Gemini sinh ra được gửi dần theo từng đoạn. Mỗi sự kiện mặc định có data {"text": "..."},
+    kết thúc bằng sự kiện "done" gồm số lần gọi Gemini (llm_calls, thay cho header X-LLM-Calls vốn đã được
+    gửi trước khi có câu trả lời) và timeline của request nếu trace=true.
+    """
+    plan = RequestPlan()
+
+    async def events():
+        prepaid = {}
+        prepaid_tokens.set(prepaid)
+        try:
+            async for part in answer_question(question, user_lat, user_lon, stream=True, plan=plan):
+                yield f"data: {json.dumps({'text': part}, ensure_ascii=False)}\n\n"
+        finally:
+            release_prepaid(prepaid)  # kể cả khi client ngắt kết nối giữa chừng (generator có thể bị đóng ở task khác)
+        record_request_metrics(plan, "/ask/stream", question)
+        counter = llm_call_counter.get()
+        done = {"llm_calls": counter["llm_calls"] if counter is not None else 0}
+        if trace:
+            done["trace"] = plan.trace()
+        yield f"event: done\ndata: {json.dumps(done, ensure_ascii=False)}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+# Loại dữ liệu OWM mà intent ưu tiên thấp (đều gọi Gemini) lấy trước lời gọi Gemini; place_recommendation không gọi OWM
+LOW_PRIORITY_WEATHER_TYPE = {"clothing_advice_today": "weather", "clothing_advice_tomorrow": "forecast", "unknown": "weather"}
+
+def admit_request(intent, city, place_name):
+    """
+    Trả về None nếu nhận request, ngược lại là câu trả lời từ chối. Quyết định ngay khi biết intent, trước khi tiêu token OWM nào. Intent ưu tiên thấp (đều gọi Gemini)
+    bị từ chối khi cần gọi OWM mà OWM lúc này không còn token cho ưu tiên thấp, hoặc khi không lấy trước được
+    token Gemini: nếu để tới lượt gọi Gemini mới bị loại thì token OWM đã tiêu cho nó là mất, trong khi có thể
+    dùng để trả lời một câu hỏi thời tiết.
+    """
+    priority = request_priority.get()
+    if intent not in LOW_PRIORITY_INTENTS or priority == PRIORITY_HIGH:
+        return None
+    weather_type = LOW_PRIORITY_WEATHER_TYPE.get(intent)
+    if intent == "unknown" and (not city or place_name):
+        weather_type = None  # chỉ hỏi lại bằng Gemini, không kèm thời tiết
+    if weather_type is not None and weather_cache.get((city_cache_key(city)[0], weather_type)) is None:
+        try:
+            weather_policy = getattr(get_weather_client(), "policy", None)
+        except RuntimeError:
+            weather_policy = None
+        weather_limiter = weather_policy.limiter if weather_policy is not None else None
+        if weather_limiter is not None and not weather_limiter.has_capacity(priority):
+            weather_limiter.shed(priority)
+            return RATE_LIMITED_MESSAGE
+    if gemini_policy.limiter is not None and not gemini_policy.limiter.prepay(priority):
+        gemini_policy.limiter.shed(priority)
+        return GEMINI_RATE_LIMITED_MESSAGE
+    return None
+
+
+async def answer_question(question, user_lat=None, user_lon=None, stream=False, plan=None):
+    """
+    Xử lý câu hỏi và trả về câu trả lời theo từng phần (async generator); /ask nối các phần lại.
+    Với stream=True, phần do Gemini sinh ra được trả về dần thay vì chờ trọn câu trả lời.
+    Các bước gọi upstream được chạy qua `plan` (RequestPlan) để chạy song song khi có thể và được ghi trace.
+    """
+    plan = plan or RequestPlan()
     if not question.strip():
-        return {"message": "Vui lòng đặt câu hỏi hoặc nhập tên thành phố."}
+        yield "Vui lòng đặt câu hỏi hoặc nhập tên thành phố."
+        return
 
-    intent_details = analyze_user_intent_with_gemini(question)
-    intent_details_holder["details"] = intent_details
+    intent_details = await plan.run("intent", lambda: resolve_intent(question, plan))
+    if intent_details.get("error"):
+        yield intent_details["error"]
+        return
 
     city = intent_details.get("city")
     place_name = intent_details.get("place_name") # Lấy tên địa điểm cụ thể
     intent = intent_details.get("intent")
     num_days = intent_details.get("num_days", 1)
+    plan.tags["intent"] = intent
+    set_request_priority(intent) # Các lời gọi upstream sau đây xếp hàng theo độ ưu tiên của intent
 
-    # print(f"Endpoint received: lat={user_lat}, lon={user_lon}") # Debug
+    def fetch_weather(type):
+        return plan.run(f"owm:{type}", lambda: get_weather_data(city, type=type), deps=("intent",))
 
     # Xử lý logic thiếu thông tin cơ bản
     if intent != "unknown" and intent != "specific_place_navigation" and not city: # Cần city cho các intent thời tiết, gợi ý chung
-        prompt_extract_city_only = f"Trích xuất tên thành phố từ câu sau: \"{question}\". Chỉ trả về tên thành phố. Nếu không có, trả về 'Không tìm thấy'."
-        response_city_only = gemini_model.generate_content(prompt_extract_city_only)
-        extracted_city = response_city_only.text.strip()
-        if extracted_city != "Không tìm thấy" and extracted_city:
-            city = extracted_city
-            intent_details["city"] = city
-            intent_details_holder["details"]["city"] = city
-        else:
-             return {"message": "Xin lỗi, tôi không thể xác định tên thành phố từ câu hỏi của bạn để cung cấp thông tin. Vui lòng thử lại."}
+        yield "Xin lỗi, tôi không thể xác định tên thành phố từ câu hỏi của bạn để cung cấp thông tin. Vui lòng thử lại."
+        return
     elif intent == "specific_place_navigation" and not place_name:
-        return {"message": "Bạn muốn tôi tìm đường đến địa điểm cụ thể nào vậy?"}
+        yield "Bạn muốn tôi tìm đường đến địa điểm cụ thể nào vậy?"
+        return
     elif not city and not place_name and intent == "unknown":
-         return {"message": "Xin lỗi, tôi chưa hiểu câu hỏi của bạn. Bạn có thể hỏi về thời tiết, gợi ý trang phục, địa điểm du lịch chung, hoặc đường đi đến một địa điểm cụ thể cho một thành phố không?"}
-
+        yield "Xin lỗi, tôi chưa hiểu câu hỏi của bạn. Bạn có thể hỏi về thời tiết, gợi ý trang phục, địa điểm du lịch chung, hoặc đường đi đến một địa điểm cụ thể cho một thành phố không?"
+        return
+    refusal = admit_request(intent, city, place_name)
+    if refusal:
+        yield refusal
+        return
 
     # Xử lý các intent
     if intent == "current_weather":
-        # ... (giữ nguyên)
-        data, error = get_weather_data(city, weather_api_key, type="weather")
-        if error: return {"message": error}
-        response_text, _ = format_current_weather(data, city_name_override=city)
-        return {"message": response_text}
+        data, error = await fetch_weather("weather")
+        if error:
+            yield error
+            return
+        with plan.span("format", deps=("owm:weather",)):
+            response_text, _ = format_current_weather(data, city_name_override=city)
+        yield response_text
+
     elif intent == "clothing_advice_today":
-        # ... (giữ nguyên)
-        data, error = get_weather_data(city, weather_api_key, type="weather")
-        if error: return {"message": error}
-        current_weather_text, weather_info = format_current_weather(data, city_name_override=city)
-        if not weather_info: return {"message": f"Không có đủ thông tin thời tiết cho {city} để đưa ra lời khuyên."}
-        advice = get_clothing_advice(weather_info, f"hôm nay tại {city}")
-        return {"message": f"{current_weather_text}\n\n{advice}"}
+        data, error = await fetch_weather("weather")
+        if error:
+            yield error
+            return
+        with plan.span("format", deps=("owm:weather",)):
+            current_weather_text, weather_info = format_current_weather(data, city_name_override=city)
+        if not weather_info:
+            yield f"Không có đủ thông tin thời tiết cho {city} để đưa ra lời khuyên."
+            return
+        yield f"{current_weather_text}\n\n"
+        async for part in clothing_advice_parts(weather_info, "hôm nay", stream, plan):
+            yield part
 
     elif intent == "forecast_tomorrow" or (intent == "forecast_next_days" and num_days == 1):
-        # ... (giữ nguyên)
-        data, error = get_weather_data(city, weather_api_key, type="forecast")
-        if error: return {"message": error}
-        response_text, _ = format_daily_forecast(data, 1, city_name_override=city)
-        return {"message": response_text}
+        data, error = await fetch_weather("forecast")
+        if error:
+            yield error
+            return
+        with plan.span("format", deps=("owm:forecast",)):
+            response_text, _ = format_daily_forecast(data, 1, intent, city_name_override=city)
+        yield response_text
 
     elif intent == "clothing_advice_tomorrow":
-        # ... (giữ nguyên)
-        data, error = get_weather_data(city, weather_api_key, type="forecast")
-        if error: return {"message": error}
-        forecast_text, weather_info_tomorrow = format_daily_forecast(data, 1, city_name_override=city)
+        data, error = await fetch_weather("forecast")
+        if error:
+            yield error
+            return
+        with plan.span("format", deps=("owm:forecast",)):
+            forecast_text, weather_info_tomorrow = format_daily_forecast(data, 1, intent, city_name_override=city)
         if not weather_info_tomorrow:
             if "Không có dữ liệu dự báo" in forecast_text or "chưa có đủ dữ liệu" in forecast_text:
-                 return {"message": forecast_text}
-            return {"message": f"Không có đủ thông tin thời tiết cho ngày mai tại {city} để đưa ra lời khuyên."}
-        advice = get_clothing_advice(weather_info_tomorrow, f"ngày mai tại {city}")
-        return {"message": f"{forecast_text}\n\n{advice}"}
+                yield forecast_text
+                return
+            yield f"Không có đủ thông tin thời tiết cho ngày mai tại {city} để đưa ra lời khuyên."
+            return
+        yield f"{forecast_text}\n\n"
+        async for part in clothing_advice_parts(weather_info_tomorrow, "ngày mai", stream, plan):
+            yield part
 
     elif intent == "forecast_next_days":
-        # ... (giữ nguyên)
         clamped_num_days = max(1, min(num_days, 5))
-        data, error = get_weather_data(city, weather_api_key, type="forecast")
-        if error: return {"message": error}
-        response_text, _ = format_daily_forecast(data, clamped_num_days, city_name_override=city)
-        return {"message": response_text}
-    
+        data, error = await fetch_weather("forecast")
+        if error:
+            yield error
+            return
+        with plan.span("format", deps=("owm:forecast",)):
+            response_text, _ = format_daily_forecast(data, clamped_num_days, intent, city_name_override=city)
+        yield response_text
+
     elif intent == "place_recommendation":
         if not city:
-            return {"message": "Bạn muốn tôi gợi ý địa điểm ở thành phố nào vậy?"}
-        recommendations_html = get_place_recommendations_from_gemini(city)
-        return {"message": recommendations_html}
-    
+            yield "Bạn muốn tôi gợi ý địa điểm ở thành phố nào vậy?"
+            return
+        if stream:
+            with plan.span("gemini:places", deps=("intent",)):
+                async for part in stream_place_recommendations(city):
+                    yield part
+        else:
+            yield await plan.run("gemini:places", lambda: get_place_recommendations_from_gemini(city), deps=("intent",))
+
     elif intent == "specific_place_navigation":
-        if not place_name: # Đã kiểm tra ở trên, nhưng thêm an toàn
-            return {"message": "Bạn muốn tìm đường đến địa điểm nào?"}
         # city có thể rỗng nếu place_name đã đủ rõ (VD: "Sân bay Nội Bài")
         # hoặc city được trích xuất từ place_name.
-        navigation_html = get_navigation_link_html(place_name, city_context=city, user_lat=user_lat, user_lon=user_lon)
-        return {"message": navigation_html}
-        
+        yield get_navigation_link_html(place_name, city_context=city, user_lat=user_lat, user_lon=user_lon)
+
     elif intent == "unknown":
-        # ... (logic hiện tại có thể giữ nguyên hoặcปรับปรุง)
-        if city or place_name: # Nếu có thông tin nào đó
-            default_info = ""
-            if city and not place_name: # Ưu tiên thời tiết nếu chỉ có city
-                data, error = get_weather_data(city, weather_api_key, type="weather")
-                if not error:
-                    default_info, _ = format_current_weather(data, city_name_override=city)
-
-            clarification_context = f"Người dùng đã hỏi: \"{question}\"."
-            if default_info:
-                clarification_context += f" Tôi đã cung cấp thông tin: \"{default_info}\"."
-            
-            clarification_prompt = f"""{clarification_context}
-            Hãy hỏi người dùng một cách thân thiện xem họ muốn biết cụ thể thông tin gì khác không (ví dụ: dự báo, mặc gì, địa điểm tham quan, đường đi tới một nơi cụ thể).
-            Câu trả lời của bạn:"""
+        # Ở đây chắc chắn có city hoặc place_name (trường hợp không có gì đã xử lý ở trên).
+        # Thời tiết hiện tại và câu hỏi làm rõ từ Gemini không phụ thuộc nhau nên được chạy song song.
+        weather_task = None
+        clarification_context = f"Người dùng đã hỏi: \"{question}\"."
+        if city and not place_name: # Ưu tiên thời tiết nếu chỉ có city
+            weather_task = plan.spawn("owm:weather", lambda: get_weather_data(city, type="weather"), deps=("intent",))
+            clarification_context += f" Tôi đang cung cấp thông tin thời tiết hiện tại ở {city}."
+
+        clarification_prompt = f"""{clarification_context}
+        Hãy hỏi người dùng một cách thân thiện xem họ muốn biết cụ thể thông tin gì khác không (ví dụ: dự báo, mặc gì, địa điểm tham quan, đường đi tới một nơi cụ thể).
+        Câu trả lời của bạn:"""
+        fallback = "Bạn có muốn biết thêm thông tin gì khác không?"
+        if stream:
+            clarification = plan.spawn_stream("gemini:clarification", lambda: stream_content(clarification_prompt), deps=("intent",))
+        else:
+            clarification_task = plan.spawn("gemini:clarification", lambda: generate_content(clarification_prompt), deps=("intent",))
+
+        if weather_task is not None:
+            data, error = await weather_task
+            if not error:
+                default_info, _ = format_current_weather(data, city_name_override=city)
+                yield default_info + "\n\n"
+
+        if stream:
+            started = False
             try:
-                clarification_response = gemini_model.generate_content(clarification_prompt)
-                final_message = (default_info + "\n\n" if default_info else "") + clarification_response.text.strip()
-                return {"message": final_message}
+                async for text in clarification:
+                    text = text if started else text.lstrip()
+                    started = started or bool(text)
+                    yield text
             except Exception:
-                 return {"message": (default_info + "\n\n" if default_info else "") + "Bạn có muốn biết thêm thông tin gì khác không?"}
-        else: # Hoàn toàn không có thông tin city hay place
-            return {"message": "Xin lỗi, tôi chưa hiểu rõ câu hỏi của bạn. Bạn có thể cung cấp tên thành phố, địa điểm và yêu cầu cụ thể hơn không?"}
-            
+                if not started:
+                    yield fallback
+        else:
+            try:
+                clarification_response = await clarification_task
+                yield clarification_response.text.strip()
+            except Exception:
+                yield fallback
+
     else: # Các trường hợp intent khác chưa xử lý (nếu có)
-        return {"message": "Xin lỗi, tôi chưa hiểu yêu cầu của bạn. Tôi có thể giúp bạn về thời tiết, trang phục, gợi ý địa điểm hoặc chỉ đường."}
\ No newline at end of file
+        yield "Xin lỗi, tôi chưa hiểu yêu cầu của bạn. Tôi có thể giúp bạn về thời tiết, trang phục, gợi ý địa điểm hoặc chỉ đường."
+
+
+async def clothing_advice_parts(weather_info, day_label, stream, plan):
+    deps = ("format",)
+    if stream:
+        with plan.span("gemini:clothing", deps=deps):
+            async for part in stream_clothing_advice(weather_info, day_label):
+                yield part
+    else:
+        yield await plan.run("gemini:clothing", lambda: get_clothing_advice(weather_info, day_label), deps=deps)
+
+
+BATCH_INTENTS = ["current_weather", "forecast_tomorrow", "forecast_next_days"]
+MAX_BATCH_ITEMS = int(os.getenv("MAX_BATCH_ITEMS", "50"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "10"))
+
+class BatchItem(BaseModel):
+    city: str
+    intent: str = "current_weather"
+    num_days: int = 1
+
+class BatchRequest(BaseModel):
+    items: list[BatchItem] = Field(..., max_length=MAX_BATCH_ITEMS)
+
+
+@router.post("/batch")
+async def ask_weather_batch(request: BatchRequest):
+    """
+    Thời tiết cho nhiều thành phố trong một request, không qua bước phân tích ý định.
+    Mỗi thành phố chỉ được gọi upstream một lần dù xuất hiện nhiều lần; thời tiết hiện tại của các
+    thành phố có city ID được gộp vào endpoint /group. Lỗi được báo riêng cho từng mục.
+    """
+    items = request.items
+    weather_cities = {city_cache_key(item.city)[0]: item.city for item in items if item.intent == "current_weather"}
+    forecast_cities = {city_cache_key(item.city)[0]: item.city for item in items if item.intent in ("forecast_tomorrow", "forecast_next_days")}
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def fetch(city, type):
+        async with semaphore:
+            return await get_weather_data(city, type=type)
+
+    weather_results, forecast_results = await asyncio.gather(
+        fetch_current_weather_batch(list(weather_cities.values()), fetch),
+        asyncio.gather(*(fetch(city, "forecast") for city in forecast_cities.values())),
+    )
+    forecast_results = dict(zip(forecast_cities, forecast_results))
+    results = []
+    for item in items:
+        if item.intent not in BATCH_INTENTS:
+            results.append({"city": item.city, "intent": item.intent, "ok": False,
+                            "error": f"Intent '{item.intent}' không được hỗ trợ trong batch. Hỗ trợ: {', '.join(BATCH_INTENTS)}."})
+            continue
+        key, _ = city_cache_key(item.city)
+        data, error = weather_results[key] if item.intent == "current_weather" else forecast_results[key]
+        if error:
+            results.append({"city": item.city, "intent": item.intent, "ok": False, "error": error})
+        else:
+            results.append(format_batch_item(item, data))
+    return {"results": results}
+
+
+async def fetch_current_weather_batch(cities, fetch):
+    """
+    Thời tiết hiện tại cho nhiều thành phố: lấy từ cache nếu có, các thành phố có city ID được gộp
+    thành các lần gọi /group (mỗi lần tối đa GROUP_MAX_IDS), còn lại gọi riêng từng thành phố.
+    Trả về {city_cache_key: (data, error)} và ghi kết quả vào weather_cache để /ask dùng lại.
+    """
+    results = {}
+    by_id = {}
+    singles = []
+    for city in cities:
+        key, location = city_cache_key(city)
+        if location is None or location.id is None:
+            singles.append(city) # get_weather_data tự dùng cache
+            continue
+        cached = weather_cache.lookup((key, "weather"))
+        if cached is not None:
+            results[key] = cached
+        else:
+            by_id.setdefault(location.id, []).append(city)
+
+    async def fetch_group(ids):
+        try:
+            payloads, error = await get_weather_client().get_group(ids)
+        except RuntimeError as e:
+            payloads, error = None, str(e)
+        if error:
+            # /group lỗi thì thử lại từng thành phố để lỗi (nếu có) được báo đúng cho từng mục
+            singles.extend(city for city_id_ in ids for city in by_id[city_id_])
+            return
+        for payload in payloads:
+            for city in by_id.get(payload.get("id"), []):
+                key, _ = city_cache_key(city)
+                results[key] = (payload, None)
+                weather_cache.set((key, "weather"), (payload, None), ttl=WEATHER_CACHE_TTL["weather"])
+        missing = [city for city_id_ in ids for city in by_id[city_id_] if city_cache_key(city)[0] not in results]
+        singles.extend(missing)
+
+    ids = list(by_id)
+    await asyncio.gather(*(fetch_group(ids[i:i + GROUP_MAX_IDS]) for i in range(0, len(ids), GROUP_MAX_IDS)))
+    single_results = await asyncio.gather(*(fetch(city, "weather") for city in singles))
+    for city, result in zip(singles, single_results):
+        results[city_cache_key(city)[0]] = result
+    return results
+
+
+def format_batch_item(item, data):
+    if item.intent == "current_weather":
+        message, weather_info = format_current_weather(data, city_name_override=item.city)
+        return {"city": item.city, "intent": item.intent, "ok": weather_info is not None,
+                "message": message, "data": weather_info}
+    num_days = 1 if item.intent == "forecast_tomorrow" else max(1, min(item.num_days, 5))
+    message, _ = format_daily_forecast(data, num_days, item.intent, city_name_override=item.city)
+    today = city_today(data)
+    days = [
+        {**day, "date": day["date"].isoformat()}
+        for day in aggregate_forecast(data) if day["date"] > today
+    ][:num_days] if "list" in data else []
+    return {"city": item.city, "intent": item.intent, "ok": bool(days), "message": message, "data": days}
+
+
+app = create_app()
@@ -0,0 +1,84 @@
+import bisect
+import math
+
+# Mốc (giây) mặc định cho histogram độ trễ: từ 1ms tới 10s
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # phần tử cuối là +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    """
+    Gom counter và histogram theo (tên, nhãn) và xuất ra định dạng text của Prometheus.
+    Mỗi lần ghi chỉ là vài phép tra dict và một bisect nên có thể để bật thường xuyên.
+    """
+
+    def __init__(self):
+        self._histograms = {}  # tên -> {nhãn (tuple đã sắp xếp) -> Histogram}
+        self._counters = {}  # tên -> {nhãn -> giá trị}
+        self._gauges = {}  # tên -> {nhãn -> giá trị}
+        self._help = {}
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self._histograms.setdefault(name, {})
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram()
+        histogram.observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self._counters.setdefault(name, {})
+        series[key] = series.get(key, 0) + amount
+
+    def set_gauge(self, name, value, **labels):
+        self._gauges.setdefault(name, {})[tuple(sorted(labels.items()))] = value
+
+    def render(self):
+        lines = []
+        for kind, metrics in (("counter", self._counters), ("gauge", self._gauges)):
+            for name, series in sorted(metrics.items()):
+                self._header(lines, name, kind)
+                for key, value in sorted(series.items()):
+                    lines.append(f"{name}{_labels(key)} {value}")
+        for name, series in sorted(self._histograms.items()):
+            self._header(lines, name, "histogram")
+            for key, histogram in sorted(series.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + (math.inf,), histogram.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == math.inf else repr(bound)
+                    lines.append(f"{name}_bucket{_labels(key + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{_labels(key)} {histogram.sum}")
+                lines.append(f"{name}_count{_labels(key)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def _header(self, lines, name, kind):
+        if name in self._help:
+            lines.append(f"# HELP {name} {self._help[name]}")
+        lines.append(f"# TYPE {name} {kind}")
+
+
+def _labels(key):
+    if not key:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in key)
+    return "{" + ",".join(f'{label}="{value}"' for (label, _), value in zip(key, escaped)) + "}"
+
+
+REGISTRY = MetricsRegistry()
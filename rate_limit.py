@@ -0,0 +1,254 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import os
+import time
+from collections import OrderedDict
+
+from metrics import REGISTRY
+
+# Intent rẻ (chỉ cần thời tiết hoặc không cần upstream) được ưu tiên hơn intent tốn lời gọi Gemini
+PRIORITY_HIGH = 0
+PRIORITY_LOW = 1
+PRIORITY_NAMES = {PRIORITY_HIGH: "high", PRIORITY_LOW: "low"}
+LOW_PRIORITY_INTENTS = {"clothing_advice_today", "clothing_advice_tomorrow", "place_recommendation", "unknown"}
+
+# Độ ưu tiên của request hiện tại; trước khi biết intent (lúc phân tích ý định) coi là ưu tiên cao
+request_priority = contextvars.ContextVar("request_priority", default=PRIORITY_HIGH)
+# Token đã lấy trước cho request hiện tại (PriorityLimiter.prepay): (limiter, độ ưu tiên) -> số token. Là dict dùng chung
+# (không đặt lại biến) để lời gọi chạy trong task con của request cũng dùng được token đã lấy.
+prepaid_tokens = contextvars.ContextVar("prepaid_tokens", default=None)
+
+
+def set_request_priority(intent):
+    request_priority.set(PRIORITY_LOW if intent in LOW_PRIORITY_INTENTS else PRIORITY_HIGH)
+
+
+def release_prepaid(prepaid=None):
+    """
+    Trả lại bucket các token đã lấy trước nhưng không dùng (ví dụ vì lỗi thời tiết). `prepaid` mặc định là dict
+    của request hiện tại; truyền dict vào khi có thể được gọi ở context khác (generator bị đóng từ task khác).
+    """
+    prepaid = prepaid_tokens.get() if prepaid is None else prepaid
+    if not prepaid:
+        return
+    for (limiter, priority), count in prepaid.items():
+        if count:
+            limiter.bucket.tokens = min(limiter.bucket.capacity, limiter.bucket.tokens + count)
+            limiter.granted[priority] -= count
+    prepaid.clear()
+
+
+class RateLimitedError(Exception):
+    """Hết hạn mức gọi upstream: hàng đợi đầy hoặc chờ quá lâu."""
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity, clock=time.monotonic):
+        self.rate = rate  # token mỗi giây
+        self.capacity = capacity
+        self.tokens = capacity
+        self._clock = clock
+        self._updated = clock()
+
+    def refill(self):
+        now = self._clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, need=1):
+        """Lấy 1 token nếu trong bucket có ít nhất `need` token."""
+        self.refill()
+        if self.tokens >= need:
+            self.tokens -= 1
+            return True
+        return False
+
+    def time_until(self, need=1):
+        self.refill()
+        return max(need - self.tokens, 0) / self.rate
+
+
+class PriorityLimiter:
+    """
+    Giới hạn số lời gọi tới một upstream bằng token bucket (`per_minute` lời gọi/phút, tối đa `burst` liên tiếp).
+    Khi hết token, lời gọi xếp hàng theo độ ưu tiên rồi tới trước về trước; chờ quá `max_wait` giây hoặc
+    hàng đợi đầy thì bị từ chối (RateLimitedError). Lời gọi ưu tiên thấp không được dùng `reserve` token cuối,
+    và bị đẩy khỏi hàng đợi đầy để nhường chỗ cho lời gọi ưu tiên cao.
+    """
+
+    def __init__(self, name, per_minute, burst, max_queue=100, max_wait=5.0, reserve=None, clock=time.monotonic):
+        self.name = name
+        self.bucket = TokenBucket(per_minute / 60, burst, clock)
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.reserve = min(burst * 0.2 if reserve is None else reserve, max(burst - 1, 0))
+        self._waiters = []  # heap (độ ưu tiên, thứ tự, future)
+        self._order = itertools.count()
+        self._drainer = None
+        self._wakeup = None
+        self.queued = {priority: 0 for priority in PRIORITY_NAMES}
+        self.granted = {priority: 0 for priority in PRIORITY_NAMES}
+        self.rejected = {priority: 0 for priority in PRIORITY_NAMES}
+
+    def _need(self, priority):
+        return 1 + (self.reserve if priority != PRIORITY_HIGH else 0)
+
+    def prepay(self, priority=PRIORITY_HIGH):
+        """
+        Lấy ngay một token cho lời gọi sau này của request hiện tại; acquire của request đó dùng token này
+        thay vì xếp hàng. Trả về False (không lấy gì) nếu lúc này không cấp được token cho `priority`.
+        """
+        first = self._first_waiter()
+        if (first is not None and first[0] <= priority) or not self.bucket.try_acquire(self._need(priority)):
+            return False
+        self.granted[priority] += 1
+        prepaid = prepaid_tokens.get()
+        if prepaid is None:
+            prepaid = {}
+            prepaid_tokens.set(prepaid)
+        prepaid[self, priority] = prepaid.get((self, priority), 0) + 1
+        return True
+
+    def has_capacity(self, priority=PRIORITY_HIGH):
+        """Lời gọi `priority` lúc này có được cấp token ngay (không phải xếp hàng) không; không lấy token."""
+        first = self._first_waiter()
+        return (first is None or first[0] > priority) and self.bucket.time_until(self._need(priority)) == 0
+
+    def _first_waiter(self):
+        while self._waiters and self._waiters[0][2].done():
+            heapq.heappop(self._waiters)
+        return self._waiters[0] if self._waiters else None
+
+    async def acquire(self, priority=PRIORITY_HIGH, timeout=None):
+        prepaid = prepaid_tokens.get()
+        if prepaid and prepaid.get((self, priority)):
+            prepaid[self, priority] -= 1
+            return
+        first = self._first_waiter()
+        if (first is None or first[0] > priority) and self.bucket.try_acquire(self._need(priority)):
+            self.granted[priority] += 1
+            return
+        if sum(self.queued.values()) >= self.max_queue and not self._evict_for(priority):
+            self._reject(priority, "queue_full")
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._order), future))
+        self._set_queued(priority, +1)
+        if self._drainer is None or self._drainer.done():
+            self._wakeup = asyncio.Event()
+            self._drainer = asyncio.ensure_future(self._drain())
+        else:
+            self._wakeup.set()  # lời gọi ưu tiên cao có thể được cấp token sớm hơn lời gọi đang chờ
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(future, self.max_wait if timeout is None else min(timeout, self.max_wait))
+        except asyncio.TimeoutError:
+            self._reject(priority, "timeout")
+        finally:
+            self._set_queued(priority, -1)
+        self.granted[priority] += 1
+        REGISTRY.observe("rate_limit_wait_seconds", time.perf_counter() - start,
+                         limiter=self.name, priority=PRIORITY_NAMES[priority])
+
+    def _evict_for(self, priority):
+        """Đẩy lời gọi đến sau cùng có độ ưu tiên thấp hơn `priority` ra khỏi hàng đợi."""
+        candidates = [waiter for waiter in self._waiters if waiter[0] > priority and not waiter[2].done()]
+        if not candidates:
+            return False
+        victim_priority, _, future = max(candidates)
+        self.rejected[victim_priority] += 1
+        REGISTRY.inc("rate_limit_rejections_total", limiter=self.name,
+                     priority=PRIORITY_NAMES[victim_priority], reason="evicted")
+        future.set_exception(RateLimitedError(f"{self.name}: nhường chỗ cho request ưu tiên cao hơn"))
+        return True
+
+    def shed(self, priority):
+        """Ghi nhận một request bị từ chối trước khi gọi upstream (has_capacity hoặc prepay trả về False)."""
+        self.rejected[priority] += 1
+        REGISTRY.inc("rate_limit_rejections_total", limiter=self.name, priority=PRIORITY_NAMES[priority], reason="shed")
+
+    def _reject(self, priority, reason):
+        self.rejected[priority] += 1
+        REGISTRY.inc("rate_limit_rejections_total", limiter=self.name, priority=PRIORITY_NAMES[priority], reason=reason)
+        raise RateLimitedError(f"{self.name}: vượt hạn mức gọi ({reason})")
+
+    def _set_queued(self, priority, delta):
+        self.queued[priority] += delta
+        REGISTRY.set_gauge("rate_limit_queue_depth", self.queued[priority],
+                           limiter=self.name, priority=PRIORITY_NAMES[priority])
+
+    async def _drain(self):
+        while True:
+            first = self._first_waiter()
+            if first is None:
+                return
+            priority, _, future = first
+            need = self._need(priority)
+            if self.bucket.try_acquire(need):
+                heapq.heappop(self._waiters)
+                future.set_result(None)
+            else:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.bucket.time_until(need))
+                except asyncio.TimeoutError:
+                    pass
+
+    def stats(self):
+        self.bucket.refill()
+        return {
+            "tokens": round(self.bucket.tokens, 2),
+            "per_minute": self.bucket.rate * 60,
+            "burst": self.bucket.capacity,
+            **{
+                PRIORITY_NAMES[priority]: {
+                    "queued": self.queued[priority],
+                    "granted": self.granted[priority],
+                    "rejected": self.rejected[priority],
+                }
+                for priority in PRIORITY_NAMES
+            },
+        }
+
+
+def limiter_from_env(name, prefix, default_burst):
+    """
+    Tạo PriorityLimiter từ biến môi trường {prefix}_RATE_LIMIT (lời gọi/phút, 0 hoặc không đặt để tắt),
+    {prefix}_RATE_BURST, {prefix}_RATE_MAX_QUEUE và {prefix}_RATE_MAX_WAIT (giây).
+    """
+    per_minute = float(os.getenv(f"{prefix}_RATE_LIMIT", "0"))
+    if per_minute <= 0:
+        return None
+    return PriorityLimiter(
+        name,
+        per_minute,
+        burst=float(os.getenv(f"{prefix}_RATE_BURST", str(default_burst))),
+        max_queue=int(os.getenv(f"{prefix}_RATE_MAX_QUEUE", "100")),
+        max_wait=float(os.getenv(f"{prefix}_RATE_MAX_WAIT", "5")),
+    )
+
+
+class ClientRateLimiter:
+    """Token bucket riêng cho từng IP client (giữ tối đa `max_clients` IP gần nhất)."""
+
+    def __init__(self, per_minute, burst, max_clients=10000, clock=time.monotonic):
+        self.rate = per_minute / 60
+        self.burst = burst
+        self.max_clients = max_clients
+        self._clock = clock
+        self._buckets = OrderedDict()
+        self.rejected = 0
+
+    def allow(self, client):
+        """Trả về 0 nếu được phép, ngược lại là số giây nên chờ trước khi thử lại."""
+        bucket = self._buckets.get(client)
+        if bucket is None:
+            bucket = self._buckets[client] = TokenBucket(self.rate, self.burst, self._clock)
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        self._buckets.move_to_end(client)
+        if bucket.try_acquire():
+            return 0
+        self.rejected += 1
+        return bucket.time_until()
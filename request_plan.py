@@ -0,0 +1,144 @@
+import asyncio
+import contextvars
+import time
+from contextlib import contextmanager
+
+_DONE = object()
+
+# Nhãn của span đang chạy, để code bên trong bước (cache, client upstream) gắn thêm thông tin
+_current_span_tags = contextvars.ContextVar("current_span_tags", default=None)
+
+
+def tag_span(**tags):
+    """Gắn nhãn (ví dụ cache="hit", status="200") vào span đang chạy; không làm gì nếu ngoài span."""
+    current = _current_span_tags.get()
+    if current is not None:
+        current.update(tags)
+
+
+class RequestPlan:
+    """
+    Đồ thị phụ thuộc nhỏ cho các bước của một request (gọi OpenWeatherMap, Gemini, định dạng...).
+    Các bước không phụ thuộc nhau được chạy song song; mỗi bước được ghi lại thành một span
+    để có thể xem lại timeline và đường găng (critical path) của request.
+    """
+
+    def __init__(self, clock=time.perf_counter):
+        self._clock = clock
+        self._t0 = clock()
+        self.tasks = {}  # tên bước -> asyncio.Task
+        self.spans = []  # (tên, bắt đầu, kết thúc, các bước phụ thuộc, nhãn)
+        self.tags = {}  # nhãn của cả request, ví dụ intent
+
+    def _unique_name(self, name):
+        if name not in self.tasks:
+            return name
+        i = 2
+        while f"{name}#{i}" in self.tasks:
+            i += 1
+        return f"{name}#{i}"
+
+    def spawn(self, name, coro_factory, deps=()):
+        """Bắt đầu một bước ngay khi các bước trong `deps` xong; trả về asyncio.Task."""
+        name = self._unique_name(name)
+        deps = tuple(dep for dep in deps if dep in self.tasks)
+        waits = [self.tasks[dep] for dep in deps if self.tasks[dep] is not None]
+
+        async def run():
+            if waits:
+                await asyncio.gather(*waits, return_exceptions=True)
+            tags = {}
+            _current_span_tags.set(tags)  # task có context riêng nên không cần khôi phục
+            start = self._clock()
+            try:
+                return await coro_factory()
+            finally:
+                self.spans.append((name, start, self._clock(), deps, tags))
+
+        task = asyncio.ensure_future(run())
+        self.tasks[name] = task
+        return task
+
+    async def run(self, name, coro_factory, deps=()):
+        return await self.spawn(name, coro_factory, deps)
+
+    def spawn_stream(self, name, agen_factory, deps=()):
+        """
+        Chạy một async generator ở nền và gom các phần vào hàng đợi, để nó tiến triển song song
+        với các bước khác. Trả về async iterator đọc lại các phần theo đúng thứ tự; đóng iterator
+        (người đọc dừng giữa chừng) thì task nền bị hủy.
+        """
+        queue = asyncio.Queue()
+
+        async def pump():
+            try:
+                async for part in agen_factory():
+                    queue.put_nowait(part)
+            except Exception as e:
+                queue.put_nowait(e)
+            finally:
+                queue.put_nowait(_DONE)
+
+        task = self.spawn(name, pump, deps)
+
+        async def drain():
+            try:
+                while True:
+                    item = await queue.get()
+                    if item is _DONE:
+                        return
+                    if isinstance(item, Exception):
+                        raise item
+                    yield item
+            finally:
+                # Người đọc dừng giữa chừng (ví dụ client SSE ngắt kết nối): ngừng đọc generator gốc
+                task.cancel()
+
+        return drain()
+
+    @contextmanager
+    def span(self, name, deps=()):
+        """Ghi lại một bước chạy trực tiếp (không tạo task), ví dụ định dạng kết quả."""
+        name = self._unique_name(name)
+        self.tasks.setdefault(name, None)
+        tags = {}
+        previous = _current_span_tags.get()
+        _current_span_tags.set(tags)
+        start = self._clock()
+        try:
+            yield
+        finally:
+            _current_span_tags.set(previous)
+            self.spans.append((name, start, self._clock(), tuple(dep for dep in deps if dep in self.tasks), tags))
+
+    def critical_path(self):
+        """Chuỗi bước dài nhất: bắt đầu từ bước kết thúc muộn nhất, lần ngược theo phụ thuộc kết thúc muộn nhất."""
+        by_name = {span[0]: span for span in self.spans}
+        if not by_name:
+            return []
+        current = max(self.spans, key=lambda span: span[2])
+        path = [current[0]]
+        while True:
+            deps = [by_name[dep] for dep in current[3] if dep in by_name]
+            if not deps:
+                break
+            current = max(deps, key=lambda span: span[2])
+            path.append(current[0])
+        return path[::-1]
+
+    def elapsed(self):
+        return self._clock() - self._t0
+
+    def trace(self):
+        def ms(t):
+            return round((t - self._t0) * 1000, 2)
+
+        return {
+            "total_ms": round(self.elapsed() * 1000, 2),
+            "tags": self.tags,
+            "spans": [
+                {"name": name, "start_ms": ms(start), "end_ms": ms(end), "deps": list(deps), "tags": tags}
+                for name, start, end, deps, tags in sorted(self.spans, key=lambda span: span[1])
+            ],
+            "critical_path": self.critical_path(),
+        }
@@ -0,0 +1,147 @@
+import asyncio
+import random
+import time
+
+from metrics import REGISTRY
+from rate_limit import request_priority
+
+
+class CircuitOpenError(Exception):
+    """Upstream đang bị ngắt mạch: lời gọi bị từ chối ngay, không chờ upstream."""
+
+
+class CircuitBreaker:
+    """
+    Ngắt mạch sau `failure_threshold` lần lỗi liên tiếp. Khi đang mở, mọi lời gọi bị từ chối ngay;
+    sau `reset_timeout` giây cho đúng một lời gọi thử (half-open): thành công thì đóng lại, lỗi thì mở tiếp.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0, clock=time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def before_call(self):
+        if self.state == "open":
+            if self._clock() - self.opened_at < self.reset_timeout:
+                REGISTRY.inc("circuit_breaker_rejections_total", upstream=self.name)
+                raise CircuitOpenError(f"{self.name} đang tạm ngắt")
+            self.state = "half_open"
+        if self.state == "half_open":
+            if self._probing:
+                REGISTRY.inc("circuit_breaker_rejections_total", upstream=self.name)
+                raise CircuitOpenError(f"{self.name} đang được thử lại")
+            self._probing = True
+
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                REGISTRY.inc("circuit_breaker_opened_total", upstream=self.name)
+            self.state = "open"
+            self.opened_at = self._clock()
+
+    def release(self):
+        """Lời gọi bị hủy giữa chừng (không rõ upstream tốt hay hỏng): cho phép lời gọi thử khác."""
+        self._probing = False
+
+    def stats(self):
+        return {"state": self.state, "consecutive_failures": self.failures}
+
+
+class UpstreamPolicy:
+    """
+    Chính sách gọi một upstream: deadline cho cả lời gọi (gồm mọi lần thử), thử lại với backoff
+    ngẫu nhiên (full jitter) cho lời gọi idempotent, và circuit breaker dùng chung cho upstream.
+    `is_failure(exc)` quyết định lỗi nào tính là upstream hỏng (ví dụ 404 không tính).
+    Nếu có `limiter` (PriorityLimiter), mỗi lần thử phải lấy được token theo độ ưu tiên của request trước khi gọi.
+    """
+
+    def __init__(self, name, deadline=10.0, retries=0, backoff=0.2, max_backoff=2.0,
+                 breaker=None, is_failure=None, rng=random.random, limiter=None):
+        self.name = name
+        self.deadline = deadline
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = breaker or CircuitBreaker(name)
+        self.is_failure = is_failure or (lambda exc: True)
+        self._rng = rng
+        self.limiter = limiter
+
+    async def _admit(self, deadline_at):
+        """Kiểm tra circuit breaker rồi chờ token; hết hạn mức (RateLimitedError) không tính là upstream lỗi."""
+        self.breaker.before_call()
+        if self.limiter is None:
+            return
+        try:
+            await self.limiter.acquire(request_priority.get(), timeout=max(deadline_at - asyncio.get_running_loop().time(), 0))
+        except BaseException:
+            self.breaker.release()
+            raise
+
+    async def call(self, coro_factory, idempotent=False):
+        loop = asyncio.get_running_loop()
+        deadline_at = loop.time() + self.deadline
+        attempt = 0
+        while True:
+            await self._admit(deadline_at)
+            try:
+                result = await asyncio.wait_for(coro_factory(), max(deadline_at - loop.time(), 0))
+            except Exception as exc:
+                failure = isinstance(exc, asyncio.TimeoutError) or self.is_failure(exc)
+                if not failure:
+                    self.breaker.record_success()  # upstream vẫn trả lời bình thường (ví dụ 404)
+                    raise
+                self.breaker.record_failure()
+                delay = self._rng() * min(self.max_backoff, self.backoff * 2 ** attempt)
+                if not idempotent or attempt >= self.retries or loop.time() + delay >= deadline_at:
+                    raise
+                REGISTRY.inc("upstream_retries_total", upstream=self.name)
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            except BaseException:
+                self.breaker.release()
+                raise
+            self.breaker.record_success()
+            return result
+
+    async def stream(self, open_stream):
+        """
+        Như call nhưng cho streaming: `open_stream()` trả về async iterable; deadline áp cho cả việc mở
+        lẫn từng đoạn nhận được. Không thử lại vì các đoạn trước đó có thể đã được gửi cho người dùng.
+        """
+        loop = asyncio.get_running_loop()
+        deadline_at = loop.time() + self.deadline
+        await self._admit(deadline_at)
+        try:
+            iterator = aiter(await asyncio.wait_for(open_stream(), max(deadline_at - loop.time(), 0)))
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(anext(iterator), max(deadline_at - loop.time(), 0))
+                except StopAsyncIteration:
+                    break
+                yield chunk
+        except Exception as exc:
+            if isinstance(exc, asyncio.TimeoutError) or self.is_failure(exc):
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            raise
+        except BaseException:
+            # Người dùng ngắt kết nối giữa chừng (GeneratorExit/CancelledError): không tính là lỗi upstream
+            self.breaker.release()
+            raise
+        self.breaker.record_success()
@@ -0,0 +1,211 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+
+def normalize_key(text):
+    """Chuẩn hóa chuỗi làm khóa cache: NFC, bỏ khoảng trắng thừa, không phân biệt hoa thường."""
+    return " ".join(unicodedata.normalize("NFC", text or "").split()).casefold()
+
+
+class TTLCache:
+    """
+    Cache trong bộ nhớ có giới hạn kích thước (loại bỏ theo LRU), mỗi mục có TTL riêng.
+    get_or_load gộp các lần miss đồng thời cho cùng một khóa thành một lần gọi loader.
+    Mục hết hạn được giữ thêm `stale_ttl` giây để get_stale trả về khi upstream gặp sự cố.
+    """
+
+    def __init__(self, maxsize=256, ttl=300.0, clock=time.monotonic, store=None, stale_ttl=0.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._clock = clock
+        self._store = None  # SQLiteStore tùy chọn để cache tồn tại qua các lần khởi động lại
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._inflight = {}  # key -> asyncio.Task
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.coalesced = 0
+        if store is not None:
+            self.attach_store(store, store.load(maxsize))
+
+    def attach_store(self, store, entries=()):
+        """
+        Dùng `store` từ giờ và nạp sẵn `entries` (kết quả store.load, có thể đọc ở thread riêng) để get không phải
+        đọc file trong event loop. Mục đã có trong cache được giữ nguyên.
+        """
+        self._store = store
+        loaded = OrderedDict(entries)
+        loaded.update(self._data)
+        self._data = loaded
+        self._evict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        now = self._clock()
+        if expires_at <= now:
+            if expires_at + self.stale_ttl <= now:
+                self._data.pop(key, None)
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def get_stale(self, key):
+        """Trả về (giá trị, số giây đã quá hạn) của mục đã hết hạn nhưng còn trong cửa sổ stale, nếu có."""
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        age = self._clock() - expires_at
+        if age < 0 or age >= self.stale_ttl:
+            return None
+        return value, age
+
+    def set(self, key, value, ttl=None):
+        expires_at = self._clock() + (self.ttl if ttl is None else ttl)
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        if self._store is not None:
+            self._store.set(key, value, expires_at)
+        self._evict()
+
+    def _evict(self):
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def lookup(self, key):
+        """Như get nhưng có tính vào số lần hit/miss."""
+        value = self.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def get_or_load(self, key, loader, ttl=None, cacheable=None):
+        """
+        Trả về giá trị trong cache nếu còn hạn; nếu không thì gọi `loader()` (coroutine function).
+        Các request miss cùng lúc cho một khóa sẽ chờ chung một lần gọi loader.
+        `cacheable(value)` quyết định có lưu kết quả hay không (ví dụ: không lưu lỗi).
+        """
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            return await asyncio.shield(task)
+        self.misses += 1
+        task = asyncio.ensure_future(self._load(key, loader, ttl, cacheable))
+        self._inflight[key] = task
+        task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _load(self, key, loader, ttl, cacheable):
+        value = await loader()
+        if value is not None and (cacheable is None or cacheable(value)):
+            self.set(key, value, ttl)
+        return value
+
+    async def flush(self):
+        """Ghi ngay các mục còn chờ xuống store (gọi khi tắt server)."""
+        if self._store is not None:
+            await self._store.flush()
+
+    def stats(self):
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+        }
+
+
+def _key_from_json(text):
+    key = json.loads(text)
+    return tuple(key) if isinstance(key, list) else key  # khóa tuple được JSON lưu thành list
+
+
+class SQLiteStore:
+    """
+    Lưu các mục cache xuống file SQLite. Khóa và giá trị được tuần tự hóa bằng JSON,
+    thời điểm hết hạn là thời gian thực (time.time) nên TTLCache dùng kèm phải có clock=time.time.
+    Không đọc/ghi file trong event loop: TTLCache nạp sẵn các mục còn hạn lúc khởi tạo (load), còn set chỉ
+    đưa mục vào hàng đợi; sau `flush_delay` giây cả hàng đợi được ghi trong một transaction ở thread riêng.
+    """
+
+    def __init__(self, path, table="cache", flush_delay=1.0):
+        self._table = table
+        self.flush_delay = flush_delay
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._conn.execute(f"DELETE FROM {table} WHERE expires_at <= ?", (time.time(),))
+        self._conn.commit()
+        self._lock = threading.Lock()  # các lần ghi theo lô có thể chạy ở nhiều thread
+        self._pending = {}  # key -> (value, expires_at) chưa ghi xuống file
+        self._flush_task = None
+        self.flushes = 0
+
+    def load(self, limit):
+        """Tối đa `limit` mục còn hạn dạng (key, (expires_at, value)), mục hết hạn muộn nhất đứng cuối."""
+        rows = self._conn.execute(
+            f"SELECT key, value, expires_at FROM {self._table} WHERE expires_at > ? ORDER BY expires_at DESC LIMIT ?",
+            (time.time(), limit),
+        ).fetchall()
+        return [(_key_from_json(key), (expires_at, json.loads(value))) for key, value, expires_at in reversed(rows)]
+
+    def set(self, key, value, expires_at):
+        self._pending[key] = (value, expires_at)
+        if self._flush_task is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:  # Không có event loop (script, lúc khởi động): ghi luôn
+            self._write(self._take_pending())
+            return
+        self._flush_task = loop.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        try:
+            await asyncio.sleep(self.flush_delay)
+        finally:
+            self._flush_task = None
+        await self.flush()
+
+    def _take_pending(self):
+        pending, self._pending = self._pending, {}
+        return pending
+
+    async def flush(self):
+        """Ghi các mục đang chờ trong một transaction, ở thread riêng."""
+        pending = self._take_pending()
+        if pending:
+            await asyncio.to_thread(self._write, pending)
+
+    def _write(self, pending):
+        rows = [
+            (json.dumps(key, ensure_ascii=False), json.dumps(value, ensure_ascii=False), expires_at)
+            for key, (value, expires_at) in pending.items()
+        ]
+        with self._lock, self._conn:  # `with conn`: commit một lần cho cả lô
+            self._conn.executemany(
+                f"INSERT OR REPLACE INTO {self._table} (key, value, expires_at) VALUES (?, ?, ?)", rows
+            )
+        self.flushes += 1
@@ -0,0 +1,134 @@
+import asyncio
+import os
+import time
+
+import httpx
+
+from metrics import REGISTRY
+from rate_limit import RateLimitedError, limiter_from_env
+from request_plan import tag_span
+from resilience import CircuitBreaker, CircuitOpenError, UpstreamPolicy
+
+GROUP_MAX_IDS = 20
+OPENWEATHERMAP_BASE_URL = os.getenv("OPENWEATHERMAP_BASE_URL", "http://api.openweathermap.org/data/2.5")
+# Câu trả lời khi OpenWeatherMap đang bị ngắt mạch hoặc hết hạn mức
+CIRCUIT_OPEN_MESSAGE = "Máy chủ thời tiết đang gặp sự cố, vui lòng thử lại sau ít phút."
+RATE_LIMITED_MESSAGE = "Hệ thống đang nhận quá nhiều yêu cầu thời tiết, vui lòng thử lại sau giây lát."
+
+
+def is_upstream_failure(exc):
+    """Lỗi 5xx/429, timeout, lỗi kết nối mới tính là OpenWeatherMap hỏng; 404 hay 401 thì không."""
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code >= 500 or exc.response.status_code == 429
+    return True
+
+
+class WeatherClient:
+    """
+    Client bất đồng bộ cho OpenWeatherMap: dùng chung một connection pool (keep-alive),
+    giới hạn số request đồng thời tới upstream và đặt timeout cho từng lần gọi.
+    Mọi lời gọi đi qua `policy` (UpstreamPolicy): deadline tổng, thử lại khi lỗi tạm thời, circuit breaker.
+    """
+
+    def __init__(self, api_key, base_url=OPENWEATHERMAP_BASE_URL, timeout=5.0,
+                 max_connections=20, max_concurrency=20, policy=None):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self._client = httpx.AsyncClient(
+            timeout=httpx.Timeout(timeout),
+            limits=httpx.Limits(max_connections=max_connections,
+                                max_keepalive_connections=max_connections),
+        )
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.policy = policy or UpstreamPolicy("owm", is_failure=is_upstream_failure)
+
+    @classmethod
+    def from_env(cls, api_key):
+        return cls(
+            api_key,
+            timeout=float(os.getenv("OWM_TIMEOUT", "5")),
+            max_connections=int(os.getenv("OWM_MAX_CONNECTIONS", "20")),
+            max_concurrency=int(os.getenv("OWM_MAX_CONCURRENCY", "20")),
+            policy=UpstreamPolicy(
+                "owm",
+                deadline=float(os.getenv("OWM_DEADLINE", "8")),
+                retries=int(os.getenv("OWM_RETRIES", "2")),
+                breaker=CircuitBreaker(
+                    "owm",
+                    failure_threshold=int(os.getenv("OWM_BREAKER_FAILURES", "5")),
+                    reset_timeout=float(os.getenv("OWM_BREAKER_RESET", "30")),
+                ),
+                is_failure=is_upstream_failure,
+                limiter=limiter_from_env("owm", "OWM", default_burst=10),
+            ),
+        )
+
+    async def get(self, city, type="weather", location=None):
+        """
+        Trả về (data, error) giống hàm get_weather_data cũ. Nếu có `location` (city_index.City),
+        gọi theo city ID hoặc tọa độ thay vì tên tự do.
+        """
+        if type not in ("weather", "forecast"):
+            return None, "Loại API không hợp lệ"
+        if location is not None and location.id:
+            params = {"id": location.id}
+        elif location is not None:
+            params = {"lat": location.lat, "lon": location.lon}
+        else:
+            params = {"q": city}
+        return await self._request(type, params, city)
+
+    async def get_group(self, city_ids):
+        """
+        Thời tiết hiện tại của nhiều thành phố trong một lần gọi (endpoint /group, tối đa GROUP_MAX_IDS id).
+        Trả về (danh sách payload giống /weather, error).
+        """
+        data, error = await self._request("group", {"id": ",".join(str(city_id) for city_id in city_ids)}, "")
+        if error:
+            return None, error
+        return data.get("list", []), None
+
+    async def _request(self, path, params, city):
+        params = {**params, "appid": self.api_key, "units": "metric", "lang": "vi"}
+        start = time.perf_counter()
+        outcome = "error"
+
+        async def send():
+            async with self._semaphore:
+                r = await self._client.get(f"{self.base_url}/{path}", params=params)
+            r.raise_for_status()
+            return r
+
+        try:
+            r = await self.policy.call(send, idempotent=True)
+            outcome = str(r.status_code)
+            return r.json(), None
+        except CircuitOpenError:
+            outcome = "circuit_open"
+            return None, CIRCUIT_OPEN_MESSAGE
+        except RateLimitedError:
+            outcome = "rate_limited"
+            return None, RATE_LIMITED_MESSAGE
+        except httpx.HTTPStatusError as http_err:
+            status = http_err.response.status_code
+            outcome = str(status)
+            if status == 404:
+                return None, f"Không tìm thấy thành phố '{city}'."
+            elif status == 401:
+                return None, "Lỗi xác thực API Key của OpenWeatherMap."
+            return None, f"Lỗi HTTP: {http_err} (mã lỗi: {status})"
+        except (httpx.TimeoutException, asyncio.TimeoutError):
+            outcome = "timeout"
+            return None, "Hết thời gian chờ phản hồi từ máy chủ thời tiết."
+        except httpx.RequestError as req_err:
+            return None, f"Lỗi kết nối: {req_err}"
+        except Exception as e:
+            return None, f"Lỗi không xác định khi gọi API thời tiết: {e}"
+        finally:
+            # Thời gian gồm cả lúc chờ semaphore và các lần thử lại, vì đó cũng là độ trễ request phải chịu
+            REGISTRY.observe("upstream_request_duration_seconds", time.perf_counter() - start,
+                             upstream="owm", endpoint=path, status=outcome)
+            tag_span(status=outcome)
+
+    async def aclose(self):
+        await self._client.aclose()